@@ -1,18 +1,68 @@
 import asyncio
 import json
+import logging
+import random
+import time
 import uuid
 import socket
+from collections import OrderedDict
+from urllib.parse import urlsplit
 
 import websockets
-from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import AsyncIOOSCUDPServer
-from pythonosc.udp_client import SimpleUDPClient
+from pythonosc.osc_message import ParseError
+
+from netosc_wire import (
+    BUNDLE_PREFIX,
+    FORMAT_BINARY,
+    FORMAT_JSON,
+    FRAME_ALIAS,
+    FRAME_ALIAS_BIND,
+    FRAME_TRACE,
+    HOP_CLIENT_IN,
+    HOP_CLIENT_OUT,
+    HOP_CLIENT_UDP_OUT,
+    HOP_CLIENT_WS_IN,
+    address_end,
+    alias_packet,
+    decode_args,
+    encode_message,
+    frame_ranges,
+    from_json_args,
+    iter_messages,
+    message_address,
+    pack_alias,
+    pack_alias_bind,
+    pack_batch,
+    pack_frame,
+    pack_traced_frame,
+    read_trace,
+    routing_addresses,
+    to_json_args,
+    trace_id,
+)
+from netosc_log import setup_logging, traffic, traffic_log
+from netosc_patterns import SubscriptionIndex
+from netosc_udp import (
+    PING,
+    UDP_HELLO,
+    UDP_KEEPALIVE,
+    UDP_MAX_PACKET,
+    UDP_OSC,
+    UDP_PING,
+    StaleFilter,
+    UDPPeer,
+    pack_hello,
+    pack_osc,
+    unpack_osc,
+)
+from osc_ingress import OSCIngress
 
 # =========================================================
 # Configuration
 # =========================================================
 
 CLIENT_ID = str(uuid.uuid4())
+CLIENT_UUID = uuid.UUID(CLIENT_ID).bytes  # origin field of binary frames
 BROKER_URL = "wss://dev.503e.foo/netOSC"
 
 OSC_LISTEN_IP = "127.0.0.1"
@@ -21,14 +71,119 @@ OSC_LISTEN_PORT = 9000
 OSC_TARGET_IP = "127.0.0.1"
 OSC_TARGET_PORT = 8000
 
+# Bridging several local applications over one broker connection:
+# OSC_LISTEN lists the (ip, port) endpoints to receive OSC on, and
+# OSC_ROUTES maps address patterns to the (ip, port) targets messages
+# from the broker are sent to, e.g.
+#
+#   OSC_LISTEN = [("127.0.0.1", 9000), ("127.0.0.1", 9001)]
+#   OSC_ROUTES = {
+#       "/mixer/*": [("127.0.0.1", 8000), ("127.0.0.1", 8001)],
+#       "/*": [("127.0.0.1", 8002)],
+#   }
+#
+# A message goes to every target of every pattern it matches, once per
+# target; messages that match none are dropped. Empty defaults to
+# OSC_LISTEN_IP/PORT and OSC_TARGET_IP/PORT. With routes and no
+# SUBSCRIBE_TOPICS the client subscribes to the route patterns.
+OSC_LISTEN = []
+OSC_ROUTES = {}
+
+# OSC address patterns ("/fader/?", "/{fader,knob}/*/value", ...) are
+# matched by the broker. They may carry options after a ";":
+# "/fader/*;latest" only wants the newest value per address when this
+# client falls behind, "/meter/*;rate=20" at most 20 messages/s per
+# address ("interval=0.05" does the same)
 SUBSCRIBE_TOPICS = ["/*"]
 
+# "binary" forwards raw OSC datagrams if the broker supports it, "json"
+# always uses JSON text frames
+WIRE_FORMAT = FORMAT_BINARY
+
+# With the binary format, ask the broker to replace repeated addresses by
+# numbers in both directions; this client numbers up to ALIAS_TABLE_SIZE
+# addresses per connection (at most 65536)
+ALIASES = True
+ALIAS_TABLE_SIZE = 4096
+
+# With the binary format, ask the broker to carry single OSC messages over
+# UDP (see netosc_udp.py) in both directions, so a lost packet only loses
+# that message instead of delaying all later ones; subscriptions, state,
+# batches and traced messages stay on the WebSocket. Datagrams go to
+# UDP_ADDRESS ((host, port), e.g. a udp_shim.py in between), by default
+# to the broker's host and the port from its welcome message.
+UDP_TRANSPORT = False
+UDP_ADDRESS = None
+
+# Outgoing messages can be held for up to BATCH_MAX_DELAY seconds and sent
+# as one frame of at most BATCH_MAX_SIZE messages. 0 sends every message
+# on its own.
+BATCH_MAX_DELAY = 0
+BATCH_MAX_SIZE = 32
+
+# Messages received while the broker is unreachable are kept, up to
+# OFFLINE_BUFFER_SIZE messages / OFFLINE_BUFFER_BYTES, for at most
+# OFFLINE_BUFFER_AGE seconds, and sent as one batch once connected again
+# (0 = drop them). With OFFLINE_COMPACT only the newest message per
+# address is kept. The byte limit keeps that batch well below the
+# broker's 1 MiB frame size limit.
+OFFLINE_BUFFER_SIZE = 1000
+OFFLINE_BUFFER_BYTES = 512 * 1024
+OFFLINE_BUFFER_AGE = 5.0
+OFFLINE_COMPACT = True
+
+# The first reconnect attempt follows after about RECONNECT_MIN_DELAY
+# seconds, each further one waits twice as long, up to RECONNECT_MAX_DELAY.
+# Every delay is randomized by +-50 % so clients don't retry in lockstep.
+RECONNECT_MIN_DELAY = 0.2
+RECONNECT_MAX_DELAY = 30
+
+# Drop outgoing messages that no subscriber (on any linked broker) wants,
+# based on the subscription patterns the broker sends with its state
+INTEREST_FILTER = True
+
+# Trace one in TRACE_SAMPLE outgoing messages (picked by a checksum of the
+# packet, 0 = off): they collect a timestamp at every hop. Traced messages
+# that arrive here are reported as JSON over UDP to TRACE_COLLECTOR
+# ((host, port), e.g. osc_tester with TRACE_PORT set).
+TRACE_SAMPLE = 0
+TRACE_COLLECTOR = None
+
+LOG_LEVEL = "INFO"
+TRAFFIC_LOG_SAMPLE = 0  # log every Nth message per address, 0 = off
+
 # =========================================================
 # Global state
 # =========================================================
 
 ws_connection = None
+link_ready = False  # welcomed or resumed on the current connection
+session_token = None  # from the broker's welcome, to resume after a drop
+subscribed_topics = None  # SUBSCRIBE_TOPICS as last sent to the broker
 known_clients = {}
+state_version = None
+wire_format = FORMAT_JSON  # negotiated with the broker on every connect
+aliases_enabled = False  # negotiated along with the wire format
+aliases_out = {}  # padded address -> alias id, for this connection
+aliases_in = {}  # the broker's alias ids -> padded address
+udp_link = None  # UDPLink while the broker offers UDP
+
+offline_buffer = OrderedDict()  # address (or number) -> (time, packet)
+offline_bytes = 0
+offline_count = 0  # numbers buffered packets that are not compacted
+offline_dropped = 0
+
+batch_items = []  # raw packets (binary) or message dicts (json)
+batch_handle = None
+
+interest = None  # SubscriptionIndex of the broker's interest, None = send all
+interest_patterns = []
+filtered = 0  # messages dropped because nobody is subscribed
+
+routes = SubscriptionIndex()  # (ip, port) target -> patterns, see set_routes
+unrouted = 0  # messages from the broker without a local target
+
+log = logging.getLogger("netosc.client")
 
 exit_event = asyncio.Event()
 reconnect_event = asyncio.Event()
@@ -37,131 +192,822 @@ reconnect_event = asyncio.Event()
 # OSC → WebSocket
 # =========================================================
 
-async def osc_handler(address, *args):
-    if ws_connection is None:
-        print("OSC received but WebSocket not connected")
-        return
-
+async def osc_handler(address, *args, trace=None):
     msg = {
-        "type": "osc",
-        "client_id": CLIENT_ID,
         "address": address,
-        "args": args
+        "args": to_json_args(args)
     }
 
-    print(f"OSC → WS | {address} {args}")
-    await ws_connection.send(json.dumps(msg))
+    if traffic.every and traffic.sample(address):
+        traffic_log.info("OSC → WS | %s %s", address, args)
+    await send_osc(msg, trace)
 
 
-def osc_handler_sync(address, *args):
-    asyncio.get_running_loop().create_task(
-        osc_handler(address, *args)
+def wanted(address):
+    return interest is None or bool(interest.match(address))
+
+
+async def osc_packet_handler(packet):
+    global filtered
+
+    if not link_ready:
+        buffer_offline(packet)
+        return
+
+    trace = start_trace(packet)
+
+    try:
+        if wire_format == FORMAT_BINARY:
+            # the broker reads the address itself, bundles included; a
+            # bundle is sent whole if anyone wants any of its messages
+            if interest is not None and not any(
+                wanted(address) for address, _, _ in routing_addresses(packet)
+            ):
+                filtered += 1
+                return
+
+            if (trace is None and udp_link is not None and udp_link.ready
+                    and len(packet) <= UDP_MAX_PACKET):
+                if traffic.every and traffic.sample(message_address(packet)):
+                    traffic_log.info("OSC → UDP | %d bytes", len(packet))
+                udp_link.send(packet)
+                return
+
+            if traffic.every and traffic.sample(message_address(packet)):
+                traffic_log.info("OSC → WS | %d bytes", len(packet))
+            await send_osc(packet, trace)
+            return
+
+        for message in iter_messages(packet):
+            address = message_address(message)
+            if not wanted(address):
+                filtered += 1
+                continue
+            await osc_handler(address, *decode_args(message), trace=trace)
+
+    except (ValueError, ParseError) as e:
+        log.warning("Dropping malformed OSC packet: %s", e)
+
+
+async def send_osc(item, trace=None):
+    if trace is not None:
+        await send_traced(item, trace)
+        return
+
+    if BATCH_MAX_DELAY > 0:
+        queue_batch(item)
+        return
+
+    if wire_format == FORMAT_BINARY:
+        await ws_connection.send(osc_frame(item))
+    else:
+        await ws_connection.send(json.dumps({"type": "osc", **item}))
+
+
+def osc_frame(packet):
+    # the binary frame for one packet, aliased if negotiated
+    if not aliases_enabled or packet.startswith(BUNDLE_PREFIX):
+        return pack_frame(CLIENT_UUID, packet)
+
+    end = address_end(packet)
+    address = packet[:end]
+    alias = aliases_out.get(address)
+    if alias is not None:
+        return pack_alias(alias, memoryview(packet)[end:])
+
+    if len(aliases_out) >= ALIAS_TABLE_SIZE:
+        return pack_frame(CLIENT_UUID, packet)
+    alias = aliases_out[address] = len(aliases_out)
+    return pack_alias_bind(alias, packet)
+
+# =========================================================
+# Tracing
+# =========================================================
+#
+# Traced messages are always sent on their own, so a traced message may
+# overtake batched ones still waiting for their flush.
+
+def start_trace(packet):
+    # a new trace for the packets picked by TRACE_SAMPLE, None for others
+    if not TRACE_SAMPLE or packet.startswith(BUNDLE_PREFIX):
+        return None
+
+    packet_id = trace_id(packet)
+    if packet_id % TRACE_SAMPLE:
+        return None
+    return {"id": packet_id, "stamps": [[HOP_CLIENT_IN, time.time()]]}
+
+
+async def send_traced(item, trace):
+    trace["stamps"].append([HOP_CLIENT_OUT, time.time()])
+
+    if wire_format == FORMAT_BINARY:
+        await ws_connection.send(pack_traced_frame(CLIENT_UUID, item, trace))
+    else:
+        await ws_connection.send(json.dumps(
+            {"type": "osc", **item, "trace": trace}
+        ))
+
+
+def report_trace(trace, address, received):
+    trace["stamps"].append([HOP_CLIENT_WS_IN, received])
+    trace["stamps"].append([HOP_CLIENT_UDP_OUT, time.time()])
+
+    if TRACE_COLLECTOR is None:
+        log.info("WS ← trace %08x | %s | %s", trace["id"], address, trace)
+        return
+
+    osc_out_sock.sendto(
+        json.dumps({
+            "type": "trace",
+            "client": CLIENT_ID,
+            "address": address,
+            **trace
+        }).encode(),
+        TRACE_COLLECTOR
     )
 
+# =========================================================
+# Offline buffer
+# =========================================================
+#
+# Packets are kept as they came in and encoded when they are sent, since
+# the wire format is only known once the broker welcomed the client.
+# Messages that arrive while connecting are buffered too, so the buffered
+# ones still go out first.
+
+def buffer_offline(packet):
+    global offline_bytes, offline_count
+
+    if not OFFLINE_BUFFER_SIZE:
+        return
+
+    if OFFLINE_COMPACT and not packet.startswith(BUNDLE_PREFIX):
+        try:
+            key = message_address(packet)
+        except ValueError:
+            return
+    else:
+        key = offline_count
+        offline_count += 1
+
+    old = offline_buffer.pop(key, None)
+    if old is not None:
+        offline_bytes -= len(old[1])
+    offline_buffer[key] = (time.monotonic(), packet)
+    offline_bytes += len(packet)
+    trim_offline()
+
+
+def trim_offline():
+    # drops the oldest packets beyond the count, size and age limits
+    global offline_bytes, offline_dropped
+
+    now = time.monotonic()
+    while offline_buffer and (
+        len(offline_buffer) > OFFLINE_BUFFER_SIZE
+        or offline_bytes > OFFLINE_BUFFER_BYTES
+        or now - next(iter(offline_buffer.values()))[0] > OFFLINE_BUFFER_AGE
+    ):
+        _, (_, packet) = offline_buffer.popitem(last=False)
+        offline_bytes -= len(packet)
+        offline_dropped += 1
+
+
+async def flush_offline():
+    global offline_bytes
+
+    trim_offline()
+    if not offline_buffer:
+        return
+
+    packets = [packet for _, packet in offline_buffer.values()]
+    offline_buffer.clear()
+    offline_bytes = 0
+    log.info("Sending %d messages buffered while offline", len(packets))
+
+    if wire_format == FORMAT_BINARY:
+        await ws_connection.send(pack_batch(CLIENT_UUID, packets))
+        return
+
+    messages = []
+    for packet in packets:
+        try:
+            for message in iter_messages(packet):
+                messages.append({
+                    "address": message_address(message),
+                    "args": to_json_args(decode_args(message))
+                })
+        except (ValueError, ParseError) as e:
+            log.warning("Dropping malformed OSC packet: %s", e)
+
+    await ws_connection.send(json.dumps({
+        "type": "batch",
+        "messages": messages
+    }))
+
+# =========================================================
+# Batching
+# =========================================================
+#
+# Batches that cannot be sent, or are still pending when the connection
+# drops, go to the offline buffer as packets, like single messages do.
+
+def queue_batch(item):
+    global batch_handle
+
+    batch_items.append(item)
+
+    if len(batch_items) >= BATCH_MAX_SIZE:
+        flush_batch()
+    elif batch_handle is None:
+        batch_handle = asyncio.get_running_loop().call_later(
+            BATCH_MAX_DELAY, flush_batch
+        )
+
+
+def flush_batch():
+    global batch_handle
+
+    if batch_handle is not None:
+        batch_handle.cancel()
+        batch_handle = None
+
+    items = batch_items.copy()
+    batch_items.clear()
+    asyncio.get_running_loop().create_task(send_batch(items))
+
+
+def unbatch_offline():
+    # moves pending batch items to the offline buffer
+    global batch_handle
+
+    if batch_handle is not None:
+        batch_handle.cancel()
+        batch_handle = None
+
+    buffer_batch(batch_items)
+    batch_items.clear()
+
+
+def buffer_batch(items):
+    for item in items:
+        if isinstance(item, dict):
+            item = encode_message(
+                item["address"], from_json_args(item["args"])
+            )
+        buffer_offline(item)
+
+
+async def send_batch(items):
+    if not items:
+        return
+
+    if not link_ready:
+        buffer_batch(items)
+        return
+
+    if traffic.every and traffic.sample("#batch"):
+        traffic_log.info("OSC → WS | batch of %d", len(items))
+
+    try:
+        if wire_format == FORMAT_BINARY:
+            await ws_connection.send(pack_batch(CLIENT_UUID, items))
+        else:
+            await ws_connection.send(json.dumps({
+                "type": "batch",
+                "messages": items
+            }))
+    except websockets.exceptions.ConnectionClosed:
+        buffer_batch(items)
+
+
+async def osc_sender(ingress):
+    # the one task forwarding received UDP packets, in arrival order
+    async for packet in ingress.packets():
+        try:
+            await osc_packet_handler(packet)
+        except websockets.exceptions.ConnectionClosed:
+            buffer_offline(packet)
+
 
 async def start_osc_server():
-    dispatcher = Dispatcher()
-    dispatcher.set_default_handler(osc_handler_sync)
+    # every listen endpoint feeds the same queue and sender task
+    loop = asyncio.get_running_loop()
+    ingress = OSCIngress()
+    transports = []
 
-    server = AsyncIOOSCUDPServer(
-        (OSC_LISTEN_IP, OSC_LISTEN_PORT),
-        dispatcher,
-        asyncio.get_running_loop()
+    for ip, port in OSC_LISTEN or [(OSC_LISTEN_IP, OSC_LISTEN_PORT)]:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: ingress, local_addr=(ip, port)
+        )
+        transports.append(transport)
+        log.info("OSC listening on %s:%s", ip, port)
+    return transports, ingress
+
+# =========================================================
+# UDP transport
+# =========================================================
+#
+# One UDP socket per broker connection, opened when the welcome message
+# offers UDP. The link says hello until the broker answers, then pings
+# every UDP_KEEPALIVE; while it is not ready (or has heard nothing for
+# UDP_TIMEOUT) messages go over the WebSocket. Messages from the broker
+# are taken whenever they arrive, minus the ones older than the last
+# message delivered for the same address.
+
+class UDPLink(asyncio.DatagramProtocol):
+    def __init__(self, token):
+        self.token = token
+        self.transport = None
+        self.peer = UDPPeer()
+        self.ready = False
+        self.task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if not data:
+            return
+
+        if data[0] == UDP_OSC:
+            self.peer.seen()
+            self.peer.received += 1
+            seq, packet = unpack_osc(data)
+            receive_udp(self.peer, seq, packet)
+
+        elif data[0] == UDP_PING:
+            self.peer.seen()
+
+        elif data[0] == UDP_HELLO and data[1:] == self.token:
+            self.peer.seen()
+            if not self.ready:
+                # the broker may have started counting from scratch
+                self.peer.streams = StaleFilter()
+                self.ready = True
+                log.info("UDP transport ready")
+
+    def error_received(self, exc):
+        # e.g. nothing listening on the broker's port (yet)
+        log.debug("UDP error: %s", exc)
+
+    def send(self, packet):
+        self.transport.sendto(pack_osc(self.peer.next_seq(), packet))
+        self.peer.sent += 1
+
+    def hello(self):
+        self.ready = False
+        self.transport.sendto(pack_hello(self.token))
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(UDP_KEEPALIVE)
+            if self.ready and self.peer.timed_out():
+                log.info("UDP transport silent, using the WebSocket")
+                self.ready = False
+
+            if self.ready:
+                self.transport.sendto(PING)
+            else:
+                self.transport.sendto(pack_hello(self.token))
+
+    def close(self):
+        self.task.cancel()
+        self.transport.close()
+
+
+def receive_udp(peer, seq, packet):
+    try:
+        elements = routing_addresses(packet)
+        if not packet.startswith(BUNDLE_PREFIX):
+            address = elements[0][0]
+            if not peer.streams.fresh(address, seq):
+                return
+            if traffic.every and traffic.sample(address):
+                traffic_log.info("UDP → OSC | %d bytes", len(packet))
+        send_local_packet(packet, 0, len(packet), elements)
+    except ValueError as e:
+        log.warning("Dropping malformed datagram: %s", e)
+
+
+async def open_udp(offer):
+    # offer: {"port": ..., "token": ...} from welcome/resumed, or None
+    global udp_link
+
+    if offer is None:
+        close_udp()
+        return
+
+    token = bytes.fromhex(offer["token"])
+    if udp_link is not None and udp_link.token == token:
+        return  # subscribed again on the same connection
+
+    close_udp()
+    address = UDP_ADDRESS or (urlsplit(BROKER_URL).hostname, offer["port"])
+    loop = asyncio.get_running_loop()
+    _, udp_link = await loop.create_datagram_endpoint(
+        lambda: UDPLink(token), remote_addr=address, family=socket.AF_INET
     )
+    udp_link.task = loop.create_task(udp_link.keepalive())
+    udp_link.hello()
+    log.info("UDP transport to %s:%s", *address)
+
+
+def close_udp():
+    global udp_link
 
-    transport, _ = await server.create_serve_endpoint()
-    print(f"OSC listening on {OSC_LISTEN_IP}:{OSC_LISTEN_PORT}")
-    return transport
+    if udp_link is not None:
+        udp_link.close()
+        udp_link = None
 
 # =========================================================
 # WebSocket → OSC
 # =========================================================
 
-osc_out_client = SimpleUDPClient(OSC_TARGET_IP, OSC_TARGET_PORT)
+osc_out_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+def set_routes(table):
+    # {pattern: [(ip, port), ...]} -> routes, indexed by target so that a
+    # target matched by several patterns still gets a message once
+    patterns = {}
+    for pattern, targets in table.items():
+        for target in targets:
+            patterns.setdefault(tuple(target), []).append(pattern)
+
+    for target in list(routes.patterns):
+        routes.remove(target)
+    for target, target_patterns in patterns.items():
+        routes.set(target, target_patterns)
+
+
+def send_local(packet, address):
+    # fans one message out to the local targets routed for its address, all
+    # from the one socket
+    global unrouted
+
+    targets = routes.match(address)
+    if not targets:
+        unrouted += 1
+        return
+    for target in targets:
+        osc_out_sock.sendto(packet, target)
+
+
+def send_local_packet(buffer, start, end, elements):
+    # The packet at buffer[start:end], with elements as found by
+    # routing_addresses. Like on the broker, a target routed for every
+    # element of a bundle gets it unchanged, others only the elements
+    # routed to them, one by one.
+    global unrouted
+
+    view = memoryview(buffer)
+    if not buffer.startswith(BUNDLE_PREFIX, start):
+        send_local(view[start:end], elements[0][0])
+        return
+
+    target_sets = [routes.match(address) for address, _, _ in elements]
+    targets = frozenset().union(*target_sets)
+    if not targets:
+        unrouted += 1
+        return
+
+    for target in targets:
+        if all(target in matched for matched in target_sets):
+            osc_out_sock.sendto(view[start:end], target)
+            continue
+
+        for (_, element_start, element_end), matched in zip(
+            elements, target_sets
+        ):
+            if target in matched:
+                osc_out_sock.sendto(view[element_start:element_end], target)
+
+
+async def request_resync():
+    if ws_connection is None:
+        return
+
+    log.info("State out of sync, requesting snapshot")
+    await ws_connection.send(json.dumps({"type": "resync"}))
+
+
+def set_interest(patterns):
+    global interest, interest_patterns
+
+    if not INTEREST_FILTER or patterns is None:
+        interest = None
+        interest_patterns = []
+        return
+
+    interest = SubscriptionIndex()
+    interest.set("broker", patterns)
+    interest_patterns = patterns
+
+
+def apply_state_delta(data):
+    for cid in data["removed"]:
+        known_clients.pop(cid, None)
+
+    for cid, topics in data["added"].items():
+        known = known_clients.setdefault(cid, [])
+        known.extend(t for t in topics if t not in known)
+        known.sort()
+
+    if "interest" in data:
+        set_interest(data["interest"])
+
+
+def send_json_osc(data):
+    received = time.time()
+
+    if traffic.every and traffic.sample(data["address"]):
+        traffic_log.info("WS → OSC | %s %s", data["address"], data["args"])
+    send_local(
+        encode_message(data["address"], from_json_args(data["args"])),
+        data["address"]
+    )
+
+    if "trace" in data:
+        report_trace(data["trace"], data["address"], received)
 
 
 async def handle_server_message(message):
-    global known_clients
+    global known_clients, state_version, wire_format, session_token
+    global link_ready, aliases_enabled
+
+    if isinstance(message, bytes):
+        received = time.time()
+
+        if message[0] in (FRAME_ALIAS, FRAME_ALIAS_BIND):
+            try:
+                packet = alias_packet(aliases_in, message)
+            except ValueError as e:
+                log.warning("Dropping aliased frame: %s", e)
+                return
+            address = message_address(packet)
+            if traffic.every and traffic.sample(address):
+                traffic_log.info("WS → OSC | %d bytes", len(packet))
+            send_local(packet, address)
+            return
+
+        try:
+            ranges = frame_ranges(message)
+        except ValueError as e:
+            log.warning("Dropping binary frame: %s", e)
+            return
+        for start, end in ranges:
+            try:
+                elements = routing_addresses(message, start, end)
+            except ValueError as e:
+                log.warning("Dropping malformed OSC packet: %s", e)
+                continue
+            if traffic.every and traffic.sample(elements[0][0]):
+                traffic_log.info("WS → OSC | %d bytes", end - start)
+            send_local_packet(message, start, end, elements)
+
+        if message[0] & FRAME_TRACE:
+            report_trace(
+                read_trace(message), message_address(message[start:]),
+                received
+            )
+        return
 
     data = json.loads(message)
 
     if data["type"] == "osc":
-        print(f"WS → OSC | {data['address']} {data['args']}")
-        osc_out_client.send_message(
-            data["address"],
-            data["args"]
-        )
+        send_json_osc(data)
+
+    elif data["type"] == "batch":
+        for msg in data["messages"]:
+            send_json_osc(msg)
+
+    elif data["type"] == "welcome":
+        wire_format = data["format"]
+        aliases_enabled = data.get("aliases", False)
+        session_token = data.get("session")
+        log.info("WS ← welcome | wire format %s", wire_format)
+        await open_udp(data.get("udp"))
+        if not link_ready:
+            link_ready = True
+            await flush_offline()
+
+    elif data["type"] == "resumed":
+        wire_format = data["format"]
+        aliases_enabled = data.get("aliases", False)
+        log.info("WS ← resumed session")
+        await open_udp(data.get("udp"))
+        link_ready = True
+        await flush_offline()
+        if subscribed_topics != SUBSCRIBE_TOPICS:
+            # topics changed while offline, the broker has the old ones
+            await send_subscriptions()
+
+    elif data["type"] == "resume_failed":
+        log.info("WS ← session expired, subscribing again")
+        await start_session()
 
     elif data["type"] == "state":
         known_clients = data["clients"]
-        print(f"WS ← state | {known_clients}")
+        state_version = data["version"]
+        set_interest(data.get("interest"))
+        log.info(
+            "WS ← state v%d | %d TX clients",
+            state_version, len(known_clients)
+        )
+
+    elif data["type"] == "state_delta":
+        # before the first snapshot arrives, or for deltas already contained
+        # in the snapshot, there is nothing to apply
+        if state_version is None or data["version"] <= state_version:
+            return
+
+        if data["version"] != state_version + 1:
+            await request_resync()
+            return
+
+        apply_state_delta(data)
+        state_version = data["version"]
+        log.info(
+            "WS ← state delta v%d | %d TX clients",
+            state_version, len(known_clients)
+        )
 
 # =========================================================
 # Subscriptions
 # =========================================================
 
+def topic_entry(topic):
+    # "/foo/*;latest;rate=20" -> {"pattern": "/foo/*", "latest": true,
+    # "rate": 20.0}
+    pattern, *options = topic.split(";")
+    if not options:
+        return pattern
+
+    entry = {"pattern": pattern}
+    for option in options:
+        key, _, value = option.partition("=")
+        entry[key.strip()] = float(value) if value else True
+    return entry
+
+
+def split_topics(text):
+    # splits on commas outside of OSC "{foo,bar}" alternatives
+    topics = []
+    current = []
+    depth = 0
+    for char in text:
+        if char == "," and depth == 0:
+            topics.append("".join(current))
+            current = []
+            continue
+
+        if char == "{":
+            depth += 1
+        elif char == "}" and depth > 0:
+            depth -= 1
+        current.append(char)
+
+    topics.append("".join(current))
+    return [t.strip() for t in topics if t.strip()]
+
+
+async def start_session():
+    global state_version, wire_format, session_token, aliases_enabled
+
+    state_version = None
+    wire_format = FORMAT_JSON
+    aliases_enabled = False
+    session_token = None
+    set_interest(None)
+    await send_subscriptions()
+
+
+async def resume_session():
+    # subscriptions, state and wire format stay as they were; the broker
+    # answers "resumed" or "resume_failed"
+    log.info("Resuming session")
+    await ws_connection.send(json.dumps({
+        "type": "resume",
+        "client_id": CLIENT_ID,
+        "session": session_token
+    }))
+
+
 async def send_subscriptions():
+    global subscribed_topics
+
     if ws_connection is None:
         return
 
     msg = {
         "type": "subscribe",
         "client_id": CLIENT_ID,
-        "topics": SUBSCRIBE_TOPICS
+        "topics": [topic_entry(topic) for topic in SUBSCRIBE_TOPICS],
+        "formats": [WIRE_FORMAT, FORMAT_JSON],
+        "aliases": ALIASES,
+        "udp": UDP_TRANSPORT
     }
 
-    print(f"Sending subscriptions: {SUBSCRIBE_TOPICS}")
+    log.info("Sending subscriptions: %s", SUBSCRIBE_TOPICS)
     await ws_connection.send(json.dumps(msg))
+    subscribed_topics = list(SUBSCRIBE_TOPICS)
 
 # =========================================================
 # WebSocket connection loop (with reconnect)
 # =========================================================
 
 async def connection_loop():
-    global ws_connection
+    global ws_connection, link_ready
 
-    backoff = 2
+    backoff = RECONNECT_MIN_DELAY
 
     while not exit_event.is_set():
         try:
-            print(f"Connecting to broker: {BROKER_URL}")
+            log.info("Connecting to broker: %s", BROKER_URL)
             async with websockets.connect(
                 BROKER_URL,
                 family=socket.AF_INET,
             ) as ws:
                 ws_connection = ws
-                print("WebSocket connected")
+                aliases_out.clear()
+                aliases_in.clear()
+                log.info("WebSocket connected")
 
-                await send_subscriptions()
-                backoff = 2  # reset after success
+                if session_token is not None:
+                    await resume_session()
+                else:
+                    await start_session()
+                backoff = RECONNECT_MIN_DELAY  # reset after success
 
                 async for message in ws:
                     await handle_server_message(message)
 
+            log.info("WebSocket closed by the broker")
+
         except Exception as e:
-            ws_connection = None
-            print(f"WebSocket disconnected: {e}")
+            log.info("WebSocket disconnected: %s", e)
 
-            if exit_event.is_set():
-                break
+        ws_connection = None
+        link_ready = False
+        unbatch_offline()
+        close_udp()
 
-            print(f"Reconnecting in {backoff}s...")
-            try:
-                await asyncio.wait_for(
-                    reconnect_event.wait(),
-                    timeout=backoff
-                )
-            except asyncio.TimeoutError:
-                pass
+        if exit_event.is_set():
+            break
+
+        delay = backoff * random.uniform(0.5, 1.5)
+        log.info("Reconnecting in %.1fs...", delay)
+        try:
+            await asyncio.wait_for(reconnect_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
 
-            reconnect_event.clear()
-            backoff = min(backoff * 2, 30)
+        reconnect_event.clear()
+        backoff = min(backoff * 2, RECONNECT_MAX_DELAY)
 
 def print_status():
     print("Status:")
     print(f"  Broker: {BROKER_URL}")
     print(f"  Connected: {'yes' if ws_connection else 'no'}")
+    print(f"  Session: {'yes' if session_token else 'no'}")
+    if OFFLINE_BUFFER_SIZE:
+        print(
+            f"  Offline buffer: {len(offline_buffer)} messages, "
+            f"{offline_bytes} bytes, {offline_dropped} dropped"
+        )
+    print(f"  Wire format: {wire_format}")
+    if udp_link is not None:
+        print(
+            f"  UDP: {'ready' if udp_link.ready else 'waiting'}, "
+            f"{udp_link.peer.sent} sent, {udp_link.peer.received} received, "
+            f"{udp_link.peer.streams.stale} stale"
+        )
+    if aliases_enabled:
+        print(
+            f"  Aliases: {len(aliases_out)} out, {len(aliases_in)} in"
+        )
+    if BATCH_MAX_DELAY > 0:
+        print(
+            f"  Batching: {BATCH_MAX_DELAY * 1000:g} ms, "
+            f"max {BATCH_MAX_SIZE} messages"
+        )
+    else:
+        print("  Batching: off")
     print(f"  Subscriptions: {SUBSCRIBE_TOPICS}")
+    if OSC_ROUTES:
+        print(
+            f"  Local routes: {len(OSC_ROUTES)} patterns, "
+            f"{len(routes.patterns)} targets, {unrouted} unrouted messages"
+        )
+    if interest is not None:
+        print(
+            f"  Interest filter: {len(interest_patterns)} patterns, "
+            f"{filtered} messages dropped"
+        )
+    else:
+        print("  Interest filter: off")
     print(f"  TX clients: {len(known_clients)}")
 
 
@@ -181,14 +1027,17 @@ def print_known_clients():
 # =========================================================
 
 async def command_loop():
+    global BATCH_MAX_DELAY, BATCH_MAX_SIZE
+
     loop = asyncio.get_running_loop()
 
     print("Commands:")
     print("  -r            reconnect")
     print("  -x            exit")
-    print("  -t <topics>   set topics (comma-separated)")
+    print("  -t <topics>   set topics (comma-separated, /a/*;latest;rate=20)")
     print("  -s            status")
     print("  -l            list known sending clients")
+    print("  -b <ms> [n]   batch outgoing messages (0 = off)")
     print()
 
     while not exit_event.is_set():
@@ -211,17 +1060,40 @@ async def command_loop():
         elif cmd == "-l":
             print_known_clients()
 
+        elif cmd.startswith("-b"):
+            parts = cmd.split()
+            try:
+                delay_ms = float(parts[1])
+                size = int(parts[2]) if len(parts) > 2 else BATCH_MAX_SIZE
+            except (IndexError, ValueError):
+                print("Usage: -b 2 [32]")
+                continue
+
+            BATCH_MAX_DELAY = max(delay_ms, 0) / 1000
+            BATCH_MAX_SIZE = max(size, 1)
+            print_status()
+
         elif cmd.startswith("-t"):
             parts = cmd.split(maxsplit=1)
             if len(parts) != 2:
-                print("Usage: -t /foo,/bar/*")
+                print(
+                    "Usage: -t /foo,/bar/*,/{fader,knob}/?;latest,"
+                    "/meter/*;rate=20"
+                )
                 continue
 
-            topics = [t.strip() for t in parts[1].split(",") if t.strip()]
+            topics = split_topics(parts[1])
             if not topics:
                 print("No topics provided")
                 continue
 
+            try:
+                for topic in topics:
+                    topic_entry(topic)
+            except ValueError:
+                print("Topic options take numbers, e.g. /meter/*;rate=20")
+                continue
+
             SUBSCRIBE_TOPICS.clear()
             SUBSCRIBE_TOPICS.extend(topics)
             print(f"Updated topics: {SUBSCRIBE_TOPICS}")
@@ -236,9 +1108,16 @@ async def command_loop():
 # =========================================================
 
 async def main():
-    osc_transport = await start_osc_server()
+    setup_logging(LOG_LEVEL, TRAFFIC_LOG_SAMPLE)
+    set_routes(
+        OSC_ROUTES or {"/*": [(OSC_TARGET_IP, OSC_TARGET_PORT)]}
+    )
+    if OSC_ROUTES and not SUBSCRIBE_TOPICS:
+        SUBSCRIBE_TOPICS.extend(OSC_ROUTES)
+    osc_transports, ingress = await start_osc_server()
 
     tasks = [
+        asyncio.create_task(osc_sender(ingress)),
         asyncio.create_task(connection_loop()),
         asyncio.create_task(command_loop()),
     ]
@@ -248,8 +1127,9 @@ async def main():
     for t in tasks:
         t.cancel()
 
-    osc_transport.close()
-    print("Client shut down")
+    for transport in osc_transports:
+        transport.close()
+    log.info("Client shut down")
 
 
 if __name__ == "__main__":
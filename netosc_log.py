@@ -0,0 +1,61 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+
+# =========================================================
+# Logging
+# =========================================================
+#
+# Log records are put on a queue as they are and formatted and written by
+# a background thread, so logging never blocks the event loop on stdout.
+# Per-message traffic goes to the "netosc.traffic" logger. It is sampled
+# per address and stays off unless a sample rate is configured.
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(message)s"
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # the stock QueueHandler formats in the calling thread; leave that to
+    # the listener thread instead
+    def prepare(self, record):
+        return record
+
+
+class TrafficSampler:
+    def __init__(self, every=0):
+        self.every = every  # log every Nth message per address, 0 = off
+        self.counts = {}
+
+    def sample(self, address):
+        count = self.counts.get(address, 0)
+        self.counts[address] = count + 1
+        return count % self.every == 0
+
+
+traffic = TrafficSampler()
+traffic_log = logging.getLogger("netosc.traffic")
+
+
+def setup_logging(level="INFO", traffic_sample=0, name=None):
+    log_queue = queue.SimpleQueue()
+
+    log_format = LOG_FORMAT
+    if name is not None:
+        log_format = log_format.replace("%(message)s", f"[{name}] %(message)s")
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(log_format))
+
+    root = logging.getLogger("netosc")
+    root.setLevel(level)
+    root.handlers[:] = [DeferredQueueHandler(log_queue)]
+    root.propagate = False
+
+    traffic.every = traffic_sample
+    traffic.counts.clear()
+
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
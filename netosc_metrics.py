@@ -0,0 +1,272 @@
+import asyncio
+from bisect import bisect_left
+from collections import defaultdict
+
+# =========================================================
+# Broker metrics
+# =========================================================
+#
+# In-process counters cheap enough to stay on under load: recording a
+# routed message is a handful of integer increments and two bucket
+# lookups, without locks (the broker runs on one event loop) and without
+# creating objects per message. Counters only ever grow; rates are left to
+# the reader (Prometheus' rate()) or taken once per METRICS_INTERVAL for
+# the stats message.
+#
+# Per-client and per-address counters stop taking new labels at
+# MAX_LABELS; everything beyond that is counted under OTHER.
+
+METRICS_INTERVAL = 1.0  # seconds between rate and loop lag samples
+MAX_LABELS = 1000
+OTHER = "_other"
+
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+ROUTE_BUCKETS = (
+    1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3, 1e-2
+)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class Histogram:
+    # fixed upper bounds; counts are made cumulative only when exported
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield bound, total
+
+
+def count(counters, key, n=1):
+    if key in counters or len(counters) < MAX_LABELS:
+        counters[key] += n
+    else:
+        counters[OTHER] += n
+
+
+class BrokerMetrics:
+    def __init__(self):
+        self.messages_in = 0
+        self.messages_out = 0
+        self.in_by_client = defaultdict(int)
+        self.in_by_address = defaultdict(int)
+        self.out_by_address = defaultdict(int)
+        self.fanout = Histogram(FANOUT_BUCKETS)
+        self.route_time = Histogram(ROUTE_BUCKETS)
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.rates = {}  # per-second rates over the last interval
+
+    def record_route(self, client_id, address, fanout, elapsed):
+        self.messages_in += 1
+        self.messages_out += fanout
+        count(self.in_by_client, client_id)
+        count(self.in_by_address, address)
+        if fanout:
+            count(self.out_by_address, address, fanout)
+        self.fanout.record(fanout)
+        self.route_time.record(elapsed)
+
+    def forget_client(self, client_id):
+        self.in_by_client.pop(client_id, None)
+
+    async def watch(self, interval=METRICS_INTERVAL):
+        # Event loop lag is how much later than asked a sleep wakes up:
+        # time spent in callbacks that kept the loop from running it. The
+        # same tick turns the counters into per-second rates.
+        loop = asyncio.get_running_loop()
+        previous = self.totals()
+
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            elapsed = loop.time() - start
+
+            self.last_lag = max(0.0, elapsed - interval)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self.loop_lag.record(self.last_lag)
+
+            current = self.totals()
+            self.rates = {
+                name: rates_since(current[name], previous[name], elapsed)
+                for name in current
+            }
+            previous = current
+
+    def totals(self):
+        return {
+            "in": {"all": self.messages_in},
+            "out": {"all": self.messages_out},
+            "in_by_client": dict(self.in_by_client),
+            "in_by_address": dict(self.in_by_address),
+            "out_by_address": dict(self.out_by_address),
+        }
+
+    def snapshot(self):
+        return {
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "rates": self.rates,
+            "fanout_mean": mean(self.fanout),
+            "route_seconds_mean": mean(self.route_time),
+            "loop_lag_seconds": self.last_lag,
+            "loop_lag_max_seconds": self.max_lag,
+        }
+
+
+def rates_since(current, previous, elapsed):
+    return {
+        key: round((value - previous.get(key, 0)) / elapsed, 2)
+        for key, value in current.items()
+        if value != previous.get(key, 0)
+    }
+
+
+def mean(histogram):
+    return histogram.sum / histogram.count if histogram.count else 0.0
+
+# =========================================================
+# Prometheus text format
+# =========================================================
+#
+# render() takes the per-client queue and per-link stats of the broker
+# (see Outbox.stats and PeerLink.stats) as they are at scrape time.
+
+QUEUE_METRICS = (
+    ("depth", "gauge", "frames waiting in the send queue"),
+    ("bytes", "gauge", "bytes waiting in the send queue"),
+    ("buffered", "gauge", "bytes in the connection's write buffer"),
+    ("sent", "counter", "frames sent"),
+    ("sent_bytes", "counter", "bytes sent"),
+    ("dropped", "counter", "frames dropped on overflow"),
+    ("conflated", "counter", "frames replaced by a newer value"),
+    ("limited", "counter", "frames skipped by a rate limit"),
+)
+
+
+def escape(value):
+    return (
+        str(value).replace("\\", "\\\\").replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def render(metrics, queues, peers, labels=None):
+    # labels: extra labels for every sample, e.g. {"worker": "worker-0"}
+    base = "".join(f'{k}="{escape(v)}",' for k, v in (labels or {}).items())
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP netosc_{name} {help_text}")
+        lines.append(f"# TYPE netosc_{name} {kind}")
+        for suffix, sample_labels, value in samples:
+            text = base + "".join(
+                f'{k}="{escape(v)}",' for k, v in sample_labels.items()
+            )
+            text = "{" + text.rstrip(",") + "}" if text else ""
+            lines.append(f"netosc_{name}{suffix}{text} {value}")
+
+    def histogram(name, help_text, hist):
+        samples = [
+            ("_bucket", {"le": bound}, total)
+            for bound, total in hist.cumulative()
+        ]
+        samples.append(("_sum", {}, hist.sum))
+        samples.append(("_count", {}, hist.count))
+        metric(name, "histogram", help_text, samples)
+
+    metric(
+        "messages_in_total", "counter", "messages routed",
+        [("", {}, metrics.messages_in)]
+    )
+    metric(
+        "messages_out_total", "counter", "frames queued for subscribers",
+        [("", {}, metrics.messages_out)]
+    )
+    metric(
+        "client_messages_in_total", "counter", "messages routed by sender",
+        [("", {"client": c}, n) for c, n in metrics.in_by_client.items()]
+    )
+    metric(
+        "address_messages_in_total", "counter", "messages routed by address",
+        [("", {"address": a}, n) for a, n in metrics.in_by_address.items()]
+    )
+    metric(
+        "address_messages_out_total", "counter",
+        "frames queued for subscribers by address",
+        [("", {"address": a}, n) for a, n in metrics.out_by_address.items()]
+    )
+    histogram("fanout", "subscribers per routed message", metrics.fanout)
+    histogram(
+        "route_seconds", "time to route one message", metrics.route_time
+    )
+    histogram(
+        "loop_lag_seconds", "event loop lag per sample", metrics.loop_lag
+    )
+    metric(
+        "loop_lag_max_seconds", "gauge", "largest event loop lag seen",
+        [("", {}, metrics.max_lag)]
+    )
+
+    for key, kind, help_text in QUEUE_METRICS:
+        suffix = "_total" if kind == "counter" else ""
+        metric(
+            f"client_queue_{key}{suffix}", kind, help_text,
+            [("", {"client": c}, s[key]) for c, s in queues.items()
+             if key in s]
+        )
+
+    for key in ("depth", "sent", "dropped"):
+        kind = "gauge" if key == "depth" else "counter"
+        suffix = "_total" if kind == "counter" else ""
+        metric(
+            f"peer_{key}{suffix}", kind, f"broker link {key}",
+            [("", {"peer": p}, s[key]) for p, s in peers.items()]
+        )
+
+    return "\n".join(lines) + "\n"
+
+# =========================================================
+# HTTP endpoint
+# =========================================================
+#
+# Just enough HTTP for a Prometheus scrape: GET /metrics answers with the
+# output of render_page(), anything else with 404.
+
+async def serve_metrics(host, port, render_page):
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass  # skip the headers
+
+            parts = request.split()
+            if len(parts) >= 2 and parts[1] in (b"/metrics", b"/"):
+                status, body = "200 OK", render_page().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
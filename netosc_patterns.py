@@ -0,0 +1,188 @@
+import re
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
+
+# =========================================================
+# OSC address patterns
+# =========================================================
+#
+# Patterns follow the netOSC rules: "/*" matches everything, a trailing "*"
+# is a prefix match and anything else must match the address exactly.
+# Besides that the OSC 1.0 pattern syntax is understood: "?" matches one
+# character, "[a-z]" / "[!abc]" one character from (or not from) a set,
+# "{foo,bar}" one of the listed strings and "*" inside a pattern any run
+# of characters within one address segment.
+#
+# Shared by the broker, which routes on the patterns clients subscribe to,
+# and the client, which drops addresses nobody is subscribed to and routes
+# incoming messages to its local targets.
+
+ROUTE_CACHE_SIZE = 4096  # addresses whose resolved targets are cached
+
+OSC_PATTERN_CHARS = frozenset("*?[]{}")
+
+
+def is_plain(pattern):
+    return OSC_PATTERN_CHARS.isdisjoint(pattern)
+
+
+@lru_cache(maxsize=ROUTE_CACHE_SIZE)
+def compile_pattern(pattern):
+    parts = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        index += 1
+
+        if char == "*":
+            # a trailing "*" keeps the netOSC prefix semantics
+            parts.append(".*" if index == len(pattern) else "[^/]*")
+
+        elif char == "?":
+            parts.append("[^/]")
+
+        elif char == "[" and "]" in pattern[index:]:
+            close = pattern.index("]", index)
+            chars = pattern[index:close]
+            negate = chars.startswith("!")
+            if negate:
+                chars = chars[1:]
+            chars = "".join(
+                c if c == "-" else re.escape(c) for c in chars
+            )
+            parts.append(f"[{'^' if negate else ''}{chars}]")
+            index = close + 1
+
+        elif char == "{" and "}" in pattern[index:]:
+            close = pattern.index("}", index)
+            choices = pattern[index:close].split(",")
+            parts.append(f"(?:{'|'.join(map(re.escape, choices))})")
+            index = close + 1
+
+        else:
+            parts.append(re.escape(char))
+
+    try:
+        return re.compile("".join(parts))
+    except re.error:
+        # e.g. a reversed range "[z-a]"; the pattern then matches literally
+        return re.compile(re.escape(pattern))
+
+
+def pattern_matches(pattern, address):
+    return compile_pattern(pattern).fullmatch(address) is not None
+
+
+# Subscription index
+#
+# Exact patterns are hashed, prefixes live in a character trie and "/*" in a
+# plain set, so resolving an address only touches subscribers that match.
+# Other OSC patterns are compiled to a regex once, when they are subscribed.
+# Resolved target sets are kept in an LRU cache per address until
+# subscriptions change.
+class SubscriptionIndex:
+    def __init__(self):
+        self.patterns = {}  # client_id -> [patterns]
+        self.exact = defaultdict(set)  # address -> {client_id}
+        self.prefixes = {}  # trie node: char -> node, "" -> {client_id}
+        self.wildcard = set()  # client_ids subscribed to "/*"
+        self.compiled = {}  # OSC pattern -> {client_id}
+        self.route_cache = OrderedDict()  # address -> frozenset(client_ids)
+
+    def kind(self, pattern):
+        if pattern == "/*":
+            return "wildcard"
+        if pattern.endswith("*") and is_plain(pattern[:-1]):
+            return "prefix"
+        if is_plain(pattern):
+            return "exact"
+        return "compiled"
+
+    def set(self, client_id, patterns):
+        self.remove(client_id)
+        self.patterns[client_id] = list(patterns)
+
+        for pattern in self.patterns[client_id]:
+            kind = self.kind(pattern)
+            if kind == "wildcard":
+                self.wildcard.add(client_id)
+            elif kind == "prefix":
+                node = self.prefixes
+                for char in pattern[:-1]:
+                    node = node.setdefault(char, {})
+                node.setdefault("", set()).add(client_id)
+            elif kind == "exact":
+                self.exact[pattern].add(client_id)
+            else:
+                compile_pattern(pattern)
+                self.compiled.setdefault(pattern, set()).add(client_id)
+
+        self.route_cache.clear()
+
+    def remove(self, client_id):
+        patterns = self.patterns.pop(client_id, None)
+        if patterns is None:
+            return
+
+        for pattern in patterns:
+            kind = self.kind(pattern)
+            if kind == "wildcard":
+                self.wildcard.discard(client_id)
+            elif kind == "prefix":
+                self._remove_prefix(self.prefixes, pattern[:-1], client_id)
+            else:
+                index = self.exact if kind == "exact" else self.compiled
+                targets = index.get(pattern)
+                if targets is not None:
+                    targets.discard(client_id)
+                    if not targets:
+                        del index[pattern]
+
+        self.route_cache.clear()
+
+    def _remove_prefix(self, node, prefix, client_id):
+        # returns True when node is empty and can be pruned by the caller
+        if not prefix:
+            targets = node.get("")
+            if targets is not None:
+                targets.discard(client_id)
+                if not targets:
+                    del node[""]
+            return not node
+
+        child = node.get(prefix[0])
+        if child is not None and self._remove_prefix(
+            child, prefix[1:], client_id
+        ):
+            del node[prefix[0]]
+        return not node
+
+    def match(self, address):
+        targets = self.route_cache.get(address)
+        if targets is not None:
+            self.route_cache.move_to_end(address)
+            return targets
+
+        found = set(self.wildcard)
+        found.update(self.exact.get(address, ()))
+
+        node = self.prefixes
+        found.update(node.get("", ()))
+        for char in address:
+            node = node.get(char)
+            if node is None:
+                break
+            found.update(node.get("", ()))
+
+        for pattern, pattern_targets in self.compiled.items():
+            if not pattern_targets <= found and (
+                compile_pattern(pattern).fullmatch(address) is not None
+            ):
+                found.update(pattern_targets)
+
+        if len(self.route_cache) >= ROUTE_CACHE_SIZE:
+            self.route_cache.popitem(last=False)
+
+        targets = frozenset(found)
+        self.route_cache[address] = targets
+        return targets
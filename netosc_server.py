@@ -1,125 +1,1835 @@
+import argparse
 import asyncio
 import json
-from collections import defaultdict
+import logging
+import multiprocessing
+import os
+import secrets
+import signal
+import socket
+import sys
+import tempfile
+import time
+import uuid
+from collections import OrderedDict, defaultdict, deque
 
 import websockets
 
+from netosc_log import setup_logging, traffic, traffic_log
+from netosc_metrics import BrokerMetrics, render, serve_metrics
+from netosc_patterns import (
+    ROUTE_CACHE_SIZE,
+    SubscriptionIndex,
+    pattern_matches,
+)
+from netosc_wire import (
+    BUNDLE_PREFIX,
+    FORMAT_BINARY,
+    FORMAT_JSON,
+    FRAME_ALIAS,
+    FRAME_ALIAS_BIND,
+    FRAME_HEADER_SIZE,
+    FRAME_OSC,
+    FRAME_TRACE,
+    HOP_BROKER_IN,
+    HOP_BROKER_OUT,
+    HOP_BROKER_QUEUED,
+    alias_packet,
+    decode_args,
+    encode_message,
+    frame_origin,
+    frame_ranges,
+    from_json_args,
+    join_frames,
+    origin_uuid,
+    pack_alias,
+    pack_alias_bind,
+    pack_frame,
+    pack_traced_frame,
+    read_trace,
+    routing_addresses,
+    to_json_args,
+)
+from netosc_udp import (
+    PING,
+    TOKEN_SIZE,
+    UDP_HEADER_SIZE,
+    UDP_HELLO,
+    UDP_KEEPALIVE,
+    UDP_MAX_PACKET,
+    UDP_OSC,
+    UDP_PING,
+    UDPPeer,
+    pack_osc,
+    unpack_osc,
+)
+from osc_ingress import INGRESS_QUEUE_SIZE
+
 # Config
 HOST = "127.0.0.1"
 PORT = 8765
+STATE_DELTA_WINDOW = 0.25  # seconds over which state changes are coalesced
+SEND_QUEUE_SIZE = 1024  # frames buffered per client before overflow
+OVERFLOW_POLICY = "drop-oldest"  # "drop-oldest", "drop-newest" or "disconnect"
+WIRE_FORMATS = [FORMAT_BINARY, FORMAT_JSON]  # formats offered to clients
+
+# Binary clients that ask for it get single messages with the address
+# replaced by a number (see netosc_wire.py). The broker numbers up to
+# ALIAS_TABLE_SIZE addresses; later ones are sent in regular frames.
+ALIASES = True
+ALIAS_TABLE_SIZE = 4096  # at most MAX_ALIASES (netosc_wire.py)
+
+# A client that disconnects keeps its subscriptions and send queue for
+# SESSION_GRACE seconds and can resume them with the session token from
+# its welcome message, without subscribing again. 0 = off.
+SESSION_GRACE = 10.0
+
+# Binary clients that ask for it send and receive single OSC messages over
+# UDP (see netosc_udp.py) on UDP_PORT (worker i uses UDP_PORT + i); the
+# WebSocket carries everything else. None = off.
+UDP_PORT = None
+LOG_LEVEL = "INFO"
+TRAFFIC_LOG_SAMPLE = 0  # log every Nth message per address, 0 = off
+
+# Retained values: the last message of every address matching one of
+# RETAIN_PATTERNS (exact addresses or patterns) is kept and sent to clients
+# as soon as they subscribe to it. Least recently updated values are
+# evicted beyond RETAIN_MAX_ENTRIES / RETAIN_MAX_BYTES, values older than
+# RETAIN_TTL seconds are dropped (None = keep until evicted).
+RETAIN_PATTERNS = []
+RETAIN_MAX_ENTRIES = 10000
+RETAIN_MAX_BYTES = 16 * 1024 * 1024
+RETAIN_TTL = None
+RETAIN_FRAME_BYTES = 512 * 1024  # retained values sent per frame, at most
+
+# Prometheus metrics are served over HTTP on METRICS_PORT (worker i uses
+# METRICS_PORT + i), None = off. The "stats" message carries them as well.
+METRICS_PORT = None
+
+# Multi-process mode: WORKERS processes share PORT (SO_REUSEPORT) and are
+# linked over Unix sockets in IPC_DIR
+WORKERS = 1
+WORKER_NAME = None  # set in worker processes
+IPC_DIR = tempfile.gettempdir()
+PEER_BUFFER_LIMIT = 4 * 1024 * 1024  # bytes queued per link before dropping
+
+# Federation: brokers listening on PEER_PORT accept links from other
+# brokers; PEERS lists "host:port" of brokers to link to
+BROKER_ID = None  # random per process, set at startup
+BROKER_NAME = None  # defaults to <hostname>:<PORT>
+PEER_PORT = None
+PEERS = []
+
+log = logging.getLogger("netosc.server")
+
+
+# Relayed messages
+#
+# A message arrives either as a raw OSC packet (binary clients) or as JSON
+# args. Each outgoing representation is built lazily and at most once, no
+# matter how many subscribers receive it. A binary frame received from a
+# publisher is passed on as it is.
+#
+# Traced messages are handed out as TracedFrame, which adds the broker's
+# queued and out stamps to the shared frame when it is actually sent.
+# Subscribers with aliases get an AliasedFrame.
+class RelayMessage:
+    __slots__ = (
+        "address", "origin", "packet", "json_args", "trace", "_binary",
+        "_json", "_aliased"
+    )
+
+    def __init__(self, address, origin, packet=None, json_args=None,
+                 frame=None, trace=None):
+        self.address = address
+        self.origin = origin
+        self.packet = packet
+        self.json_args = json_args
+        self.trace = trace
+        self._binary = frame
+        self._json = None
+        self._aliased = None
+
+    def binary_frame(self):
+        if self._binary is None:
+            packet = self.packet
+            if packet is None:
+                packet = encode_message(
+                    self.address, from_json_args(self.json_args)
+                )
+            self._binary = pack_frame(self.origin, packet)
+        return self._binary
+
+    def json_frame(self):
+        if self._json is None:
+            args = self.json_args
+            if args is None:
+                args = to_json_args(decode_args(self.packet))
+            self._json = json.dumps({
+                "type": "osc",
+                "address": self.address,
+                "args": args
+            })
+        return self._json
+
+    def aliased_frame(self):
+        # None once the broker ran out of alias numbers
+        if self._aliased is None:
+            alias = address_aliases.get(self.address)
+            if alias is None:
+                if len(address_aliases) >= ALIAS_TABLE_SIZE:
+                    return None
+                alias = address_aliases[self.address] = len(address_aliases)
+            self._aliased = AliasedFrame(self, alias)
+        return self._aliased
+
+    def frame_for(self, outbox):
+        if outbox.format == FORMAT_BINARY:
+            if outbox.aliases and self.trace is None:
+                aliased = self.aliased_frame()
+                if aliased is not None:
+                    return aliased
+            frame = self.binary_frame()
+        else:
+            frame = self.json_frame()
+
+        if self.trace is not None:
+            return TracedFrame(frame, self.trace)
+        return frame
+
+
+class AliasedFrame:
+    # The aliased frames of a message only differ in whether the receiving
+    # connection still needs the address bound. Both variants are encoded
+    # at most once, and the outbox picks one when it sends the frame, so a
+    # bind dropped from a full queue is never assumed to have arrived.
+    __slots__ = ("message", "alias", "_bind", "_short")
+
+    def __init__(self, message, alias):
+        self.message = message
+        self.alias = alias
+        self._bind = None
+        self._short = None
+
+    def packet(self):
+        packet = self.message.packet
+        if packet is None:
+            packet = memoryview(self.message.binary_frame())[
+                FRAME_HEADER_SIZE:
+            ]
+        return packet
+
+    def for_outbox(self, outbox):
+        if self.alias in outbox.bound:
+            if self._short is None:
+                start = (len(self.message.address.encode()) // 4 + 1) * 4
+                self._short = pack_alias(self.alias, self.packet()[start:])
+            return self._short
+
+        outbox.bound.add(self.alias)
+        if self._bind is None:
+            self._bind = pack_alias_bind(self.alias, self.packet())
+        return self._bind
+
+    def plain(self):
+        return self.message.binary_frame()
+
+
+def plain_frame(frame):
+    # for frames that are joined into batches, which are never aliased
+    if type(frame) is AliasedFrame:
+        return frame.plain()
+    return frame
+
+
+class TracedFrame:
+    __slots__ = ("frame", "trace", "queued")
+
+    def __init__(self, frame, trace):
+        self.frame = frame
+        self.trace = trace
+        self.queued = time.time()
+
+    def finish(self):
+        trace = {
+            "id": self.trace["id"],
+            "stamps": self.trace["stamps"] + [
+                [HOP_BROKER_QUEUED, self.queued],
+                [HOP_BROKER_OUT, time.time()],
+            ],
+        }
+
+        if isinstance(self.frame, str):
+            return f'{self.frame[:-1]}, "trace": {json.dumps(trace)}}}'
+        return pack_traced_frame(
+            self.frame[1:FRAME_HEADER_SIZE],
+            memoryview(self.frame)[FRAME_HEADER_SIZE:],
+            trace
+        )
+
+
+# Outbound queues
+#
+# Every client gets a bounded queue drained by its own writer task, so a
+# slow subscriber only backs up its own queue. When the queue is full the
+# OVERFLOW_POLICY decides whether the oldest or the newest frame is dropped,
+# or the client is disconnected. Control frames (state) are never dropped:
+# they are queued as ControlFrames, which drop-oldest skips over.
+#
+# Addresses matched by a latest-only subscription hold one slot in the
+# queue. A newer value replaces the queued one in place, so for those
+# addresses the backlog never exceeds the number of distinct addresses.
+#
+# Rate-limited subscriptions are downsampled per address before anything
+# is encoded: a message is let through when at least the subscription's
+# interval has passed since the last one, the rest is skipped.
+class LatestSlot:
+    __slots__ = ("address", "frame")
+
+    def __init__(self, address, frame):
+        self.address = address
+        self.frame = frame
+
+
+class ControlFrame:
+    __slots__ = ("frame",)
+
+    def __init__(self, frame):
+        self.frame = frame
+
+
+def frame_size(frame):
+    # bytes a queued frame takes on the wire; aliased frames count as their
+    # packet, traced ones without the trace
+    if type(frame) in (ControlFrame, LatestSlot, TracedFrame):
+        return frame_size(frame.frame)
+    if type(frame) is AliasedFrame:
+        return len(frame.packet())
+    if isinstance(frame, str):
+        return len(frame.encode())
+    return len(frame)
+
+
+class Outbox:
+    def __init__(self, client_id, ws):
+        self.client_id = client_id
+        self.ws = ws
+        self.format = FORMAT_JSON
+        self.queue = deque()
+        self.latest = {}  # address -> LatestSlot waiting in queue
+        self.limits = {}  # pattern -> min interval (s), 0 = unlimited
+        self.intervals = {}  # address -> min interval (s)
+        self.next_send = {}  # address -> earliest time for the next message
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.conflated = 0
+        self.limited = 0
+        self.closing = False
+        self.session = None  # token the client can resume this queue with
+        self.origin = origin_uuid(client_id)
+        self.aliases = False  # negotiated on subscribe
+        self.bound = set()  # alias ids bound on this connection
+        self.aliases_in = {}  # the client's alias ids -> padded address
+        self.udp_token = None  # negotiated on subscribe
+        self.udp_addr = None  # the client's UDP address once it said hello
+        self.udp = None  # UDPPeer while bound
+        self.expiry = None  # ends the session while the client is away
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def put(self, frame, control=False):
+        if control:
+            frame = ControlFrame(frame)
+        elif len(self.queue) >= SEND_QUEUE_SIZE:
+            self.dropped += 1
+
+            if OVERFLOW_POLICY == "drop-newest":
+                return
+
+            # a detached client has no connection to close
+            if OVERFLOW_POLICY == "disconnect" and self.ws is not None:
+                self.disconnect_slow_consumer()
+                return
+
+            if not self.drop_oldest():
+                return  # nothing but control frames queued
+
+        self.queue.append(frame)
+        self.ready.set()
+
+    def drop_oldest(self):
+        # removes the oldest data frame, False if there is none
+        for index, frame in enumerate(self.queue):
+            if type(frame) is ControlFrame:
+                continue
+
+            del self.queue[index]
+            if type(frame) is LatestSlot:
+                del self.latest[frame.address]
+            return True
+        return False
+
+    def put_latest(self, address, frame):
+        slot = self.latest.get(address)
+        if slot is not None:
+            slot.frame = frame
+            self.conflated += 1
+            return
+
+        slot = LatestSlot(address, frame)
+        self.put(slot)
+        if self.queue and self.queue[-1] is slot:
+            self.latest[address] = slot
+
+    def set_limits(self, limits):
+        self.limits = limits
+        self.intervals.clear()
+        self.next_send.clear()
+
+    def allow(self, address):
+        interval = self.intervals.get(address)
+        if interval is None:
+            # the most permissive matching subscription wins
+            interval = min(
+                (i for p, i in self.limits.items()
+                 if pattern_matches(p, address)),
+                default=0
+            )
+            if len(self.intervals) >= ROUTE_CACHE_SIZE:
+                self.intervals.clear()
+            self.intervals[address] = interval
+
+        now = time.monotonic()
+        next_send = self.next_send.get(address, 0)
+        if now < next_send:
+            self.limited += 1
+            return False
+
+        # keep the cadence of a steady stream, but don't save up a burst
+        if now - next_send < interval:
+            self.next_send[address] = next_send + interval
+        else:
+            self.next_send[address] = now + interval
+        return True
+
+    def send_udp(self, packet):
+        datagram = pack_osc(self.udp.next_seq(), packet)
+        udp_endpoint.transport.sendto(datagram, self.udp_addr)
+        self.udp.sent += 1
+        self.sent += 1
+        self.sent_bytes += len(datagram)
+
+    def disconnect_slow_consumer(self):
+        if self.closing:
+            return
+
+        self.closing = True
+        self.session = None  # no coming back to the lost messages
+        self.queue.clear()
+        self.latest.clear()
+        log.warning(
+            "[SLOW] %s send queue overflow, disconnecting", self.client_id
+        )
+        asyncio.get_running_loop().create_task(
+            self.ws.close(code=1008, reason="send queue overflow")
+        )
+
+    async def run(self):
+        try:
+            while True:
+                await self.ready.wait()
+                while self.queue:
+                    frame = self.queue.popleft()
+                    if type(frame) is ControlFrame:
+                        frame = frame.frame
+                    elif type(frame) is LatestSlot:
+                        del self.latest[frame.address]
+                        frame = frame.frame
+                    if type(frame) is TracedFrame:
+                        frame = frame.finish()
+                    elif type(frame) is AliasedFrame:
+                        frame = frame.for_outbox(self)
+                    await self.ws.send(frame)
+                    self.sent += 1
+                    self.sent_bytes += frame_size(frame)
+                self.ready.clear()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def detach(self):
+        # the connection is gone; keep queueing until the client resumes
+        # or the session expires
+        self.task.cancel()
+        self.ws = None
+        unbind_udp(self)
+
+    def attach(self, ws):
+        # resumes on a new connection, "resumed" goes out before the
+        # frames queued in the meantime
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        self.task.cancel()
+
+        self.ws = ws
+        self.closing = False
+        self.bound.clear()
+        self.aliases_in.clear()
+        self.queue.appendleft(ControlFrame(json.dumps({
+            "type": "resumed",
+            "format": self.format,
+            "aliases": self.aliases,
+            "udp": udp_offer(self),
+        })))
+        self.ready.set()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def close(self):
+        self.task.cancel()
+        if self.expiry is not None:
+            self.expiry.cancel()
+        forget_udp(self)
+
+    def stats(self):
+        transport = self.ws.transport if self.ws is not None else None
+        return {
+            "depth": len(self.queue),
+            "bytes": sum(map(frame_size, self.queue)),
+            "buffered": transport.get_write_buffer_size() if transport else 0,
+            "sent": self.sent,
+            "sent_bytes": self.sent_bytes,
+            "dropped": self.dropped,
+            "conflated": self.conflated,
+            "limited": self.limited,
+            "udp_sent": self.udp.sent if self.udp is not None else 0,
+        }
+
+
+# Retained values
+#
+# Kept in an OrderedDict in the order they were last updated, so the
+# least recently updated value is the first to be evicted and expired
+# values are always at the front. Values are stored as RelayMessages with
+# their own copy of the packet (and the JSON arguments if they arrived as
+# JSON), so they can be encoded for any subscriber like live traffic.
+class RetainedStore:
+    def __init__(self):
+        self.index = SubscriptionIndex()
+        self.values = OrderedDict()  # address -> (RelayMessage, time stored)
+        self.size = 0  # bytes of retained packets
+        self.evicted = 0
+
+    def set_patterns(self, patterns):
+        self.index.set("retain", patterns)
+
+    def store(self, message):
+        if not self.index.patterns or not self.index.match(message.address):
+            return
+
+        address = message.address
+        packet = message.packet
+        if packet is None:
+            packet = encode_message(address, from_json_args(message.json_args))
+        retained = RelayMessage(
+            address, message.origin, bytes(packet),
+            json_args=message.json_args
+        )
+
+        old = self.values.pop(address, None)
+        if old is not None:
+            self.size -= len(old[0].packet)
+        self.values[address] = (retained, time.monotonic())
+        self.size += len(retained.packet)
+        self.evict()
+
+    def evict(self):
+        now = time.monotonic()
+        while self.values and (
+            len(self.values) > RETAIN_MAX_ENTRIES
+            or self.size > RETAIN_MAX_BYTES
+            or (RETAIN_TTL is not None
+                and now - next(iter(self.values.values()))[1] > RETAIN_TTL)
+        ):
+            _, (message, _) = self.values.popitem(last=False)
+            self.size -= len(message.packet)
+            self.evicted += 1
+
+    def matching(self, patterns):
+        self.evict()
+        return [
+            message for address, (message, _) in self.values.items()
+            if any(pattern_matches(p, address) for p in patterns)
+        ]
+
+    def stats(self):
+        return {
+            "entries": len(self.values),
+            "bytes": self.size,
+            "evicted": self.evicted,
+        }
 
 
 # Global state
-clients = {}  # client_id -> websocket
-subscriptions = defaultdict(list)  # client_id -> [topics]
+clients = {}  # client_id -> Outbox
+subscriptions = SubscriptionIndex()
+latest_subscriptions = SubscriptionIndex()  # latest-only patterns
+limited_subscriptions = SubscriptionIndex()  # rate-limited patterns
 published_topics = defaultdict(set)  # client_id -> set(addresses)
 
+state_version = 0
+pending_added = defaultdict(set)  # client_id -> addresses new since last delta
+pending_removed = set()  # client_ids that left since last delta
+state_flush_handle = None
+client_interest = None  # union of all subscriptions as last sent to clients
 
-# Topic matching
-def topic_matches(address: str, pattern: str) -> bool:
-    if pattern == "/*":
-        return True
-    if pattern.endswith("*"):
-        return address.startswith(pattern[:-1])
-    return address == pattern
+peer_links = {}  # peer_id -> PeerLink
+remote_clients = defaultdict(set)  # peer_id -> client_ids behind that link
+peer_pending = {}  # source peer_id (None = local) -> (added, removed)
 
+metrics = BrokerMetrics()
+retained = RetainedStore()
+address_aliases = {}  # address -> alias id, numbered for all connections
 
-# State broadcast
-async def broadcast_state():
-    state_msg = {
+udp_endpoint = None  # BrokerUDP when UDP_PORT is set
+udp_tokens = {}  # hello token -> client_id
+udp_clients = {}  # client UDP address -> client_id
+
+
+# State tracking
+#
+# Clients keep a copy of published_topics. Instead of re-sending the whole
+# map on every message, changes are collected here and sent as a versioned
+# delta at most once per STATE_DELTA_WINDOW. A full snapshot is only sent on
+# subscribe or when a client asks for a resync.
+#
+# The same channel carries "interest", the union of all patterns anyone
+# (clients here or behind linked brokers) is subscribed to. Clients use it
+# to drop messages nobody wants before sending them. Retained addresses
+# count as wanted too, or their values would never reach the broker before
+# the first subscriber shows up.
+def state_snapshot():
+    return {
         "type": "state",
+        "version": state_version,
         "clients": {
-            cid: sorted(list(topics))
+            cid: sorted(topics)
             for cid, topics in published_topics.items()
+        },
+        # as of the last delta, so the next one brings any change since
+        "interest": client_interest
+    }
+
+
+def pattern_union(pattern_lists):
+    patterns = set()
+    for sub_patterns in pattern_lists:
+        patterns.update(sub_patterns)
+    for retain_patterns in retained.index.patterns.values():
+        patterns.update(retain_patterns)
+
+    if "/*" in patterns:
+        return ["/*"]
+    return sorted(patterns)
+
+
+def mark_published(client_id, address, source=None):
+    pending_added[client_id].add(address)
+    if peer_links:
+        added, _ = pending_for_peers(source)
+        added[client_id].add(address)
+    schedule_state_flush()
+
+
+def mark_left(client_id, source=None):
+    pending_added.pop(client_id, None)
+    pending_removed.add(client_id)
+    if peer_links:
+        added, removed = pending_for_peers(source)
+        added.pop(client_id, None)
+        removed.add(client_id)
+    schedule_state_flush()
+
+
+def pending_for_peers(source):
+    source_id = source.peer_id if source is not None else None
+    return peer_pending.setdefault(source_id, (defaultdict(set), set()))
+
+
+def schedule_state_flush():
+    global state_flush_handle
+
+    if state_flush_handle is not None:
+        return
+
+    loop = asyncio.get_running_loop()
+    state_flush_handle = loop.call_later(STATE_DELTA_WINDOW, flush_state)
+
+
+def flush_state():
+    global state_version, state_flush_handle, client_interest
+
+    state_flush_handle = None
+    interest = pattern_union(subscriptions.patterns.values())
+    interest_changed = interest != client_interest
+    if not pending_added and not pending_removed and not interest_changed:
+        return
+
+    # receivers apply "removed" before "added", so a client that left and
+    # came back within one window ends up with only its new addresses
+    state_version += 1
+    delta_msg = {
+        "type": "state_delta",
+        "version": state_version,
+        "removed": sorted(pending_removed),
+        "added": {
+            cid: sorted(topics)
+            for cid, topics in pending_added.items()
         }
     }
+    if interest_changed:
+        client_interest = interest
+        delta_msg["interest"] = interest
+    pending_added.clear()
+    pending_removed.clear()
 
-    message = json.dumps(state_msg)
+    message = json.dumps(delta_msg)
 
-    for ws in clients.values():
-        await ws.send(message)
+    for outbox in clients.values():
+        outbox.put(message, control=True)
+
+    for source_id, (added, removed) in peer_pending.items():
+        source = peer_links.get(source_id)
+        if source_id is not None and source is None:
+            continue  # that link is gone, and its clients with it
+
+        send_peer_state(
+            [link for link in peer_links.values() if relays_to(source, link)],
+            removed,
+            added
+        )
+    peer_pending.clear()
+
+
+def send_state_snapshot(client_id):
+    outbox = clients.get(client_id)
+    if outbox is not None:
+        outbox.put(json.dumps(state_snapshot()), control=True)
+
+
+def queue_stats():
+    return {cid: outbox.stats() for cid, outbox in clients.items()}
+
+
+def peer_stats():
+    return {pid: link.stats() for pid, link in peer_links.items()}
+
+
+def metrics_page():
+    labels = {"worker": WORKER_NAME} if WORKER_NAME is not None else None
+    return render(metrics, queue_stats(), peer_stats(), labels)
+
+# =========================================================
+# Broker links
+# =========================================================
+#
+# Brokers exchange traffic over links. In multi-process mode every worker
+# is linked to every other worker over a Unix socket (a "mesh" link);
+# federated brokers at other sites are linked over TCP. A link carries
+# the aggregated subscription patterns of everything reachable through
+# this broker, the addresses published behind it and the OSC frames the
+# other side's subscribers asked for.
+#
+# Patterns learned from a link are never announced back over it, and
+# frames are never sent back to the link they came from. Mesh links reach
+# every worker directly, so nothing is relayed from one mesh link to
+# another. Each relayed frame carries the ids of the brokers it passed
+# through and is dropped when it comes back to one of them. Federations
+# are meant to be trees; the path only keeps a misconfigured cycle from
+# looping forever (messages then arrive once per path).
+#
+# Link frames are: length (4 bytes) | kind (1 byte) | body
+
+PEER_HELLO = 0x48  # {"name": ..., "broker": <hex id>}
+PEER_INTEREST = 0x49  # [patterns]
+PEER_STATE = 0x53  # {"removed": [...], "added": {client_id: [...]}}
+PEER_OSC = 0x4F  # hops (1 byte) | hops x broker id (16 bytes) | OSC frame
+
+BROKER_ID_SIZE = 16
+MAX_HOPS = 255
+
+
+class PeerLink:
+    format = FORMAT_BINARY
+    aliases = False
+    udp = None
+
+    def __init__(self, name, broker_id, writer, mesh):
+        self.peer_id = f"peer:{name}"
+        self.broker_id = broker_id
+        self.writer = writer
+        self.mesh = mesh
+        self.interest = None  # patterns last announced to this peer
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, kind, body, control=False):
+        if isinstance(body, str):
+            body = body.encode()
+
+        if (not control and self.writer.transport.get_write_buffer_size()
+                > PEER_BUFFER_LIMIT):
+            self.dropped += 1
+            return
+
+        self.writer.write((len(body) + 1).to_bytes(4, "big") + bytes((kind,)))
+        self.writer.write(body)
+        self.sent += 1
+
+    def put(self, frame, control=False):
+        self.relay(frame, BROKER_ID)
+
+    def relay(self, frame, path):
+        hops = len(path) // BROKER_ID_SIZE
+        if hops > MAX_HOPS or path_contains(path, self.broker_id):
+            return
+        if type(frame) is TracedFrame:
+            frame = frame.finish()
+        self.send(PEER_OSC, b"".join((bytes((hops,)), path, frame)))
+
+    def stats(self):
+        return {
+            "depth": self.writer.transport.get_write_buffer_size(),
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
+
+
+def path_contains(path, broker_id):
+    return any(
+        path[i:i + BROKER_ID_SIZE] == broker_id
+        for i in range(0, len(path), BROKER_ID_SIZE)
+    )
+
+
+def relay_put(path):
+    # put function for frames received over a link: links get the path
+    def put(outbox, frame):
+        if isinstance(outbox, PeerLink):
+            outbox.relay(frame, path)
+        else:
+            outbox.put(frame)
+    return put
+
+
+def relays_to(source, link):
+    # may something received from `source` (None = local) go out on `link`
+    if source is None:
+        return True
+    return link is not source and not (source.mesh and link.mesh)
+
+
+def target_outbox(target_id, source):
+    outbox = clients.get(target_id)
+    if outbox is None:
+        link = peer_links.get(target_id)
+        if link is not None and relays_to(source, link):
+            outbox = link
+    return outbox
+
+
+def interest_summary(link):
+    # the union of all patterns whose matches may be sent out on `link`,
+    # plus what is retained here
+    def reachable(sub_id):
+        source = peer_links.get(sub_id)
+        return sub_id in clients or (
+            source is not None and relays_to(source, link)
+        )
+
+    return pattern_union(
+        sub_patterns
+        for sub_id, sub_patterns in subscriptions.patterns.items()
+        if reachable(sub_id)
+    )
+
+
+def announce_interest():
+    # peers hear about changes right away, clients with the next state delta
+    schedule_state_flush()
+
+    for link in peer_links.values():
+        interest = interest_summary(link)
+        if interest != link.interest:
+            link.interest = interest
+            link.send(PEER_INTEREST, json.dumps(interest), control=True)
+
+
+def send_peer_state(links, removed, added):
+    if not links:
+        return
+
+    body = json.dumps({
+        "removed": sorted(removed),
+        "added": {cid: sorted(topics) for cid, topics in added.items()}
+    })
+    for link in links:
+        link.send(PEER_STATE, body, control=True)
+
+
+def apply_peer_state(link, data):
+    behind_link = remote_clients[link.peer_id]
+
+    for cid in data["removed"]:
+        behind_link.discard(cid)
+        if cid in clients:
+            continue  # a session left behind elsewhere, the client is here
+        if published_topics.pop(cid, None) is not None:
+            mark_left(cid, link)
+
+    for cid, topics in data["added"].items():
+        outbox = clients.get(cid)
+        if outbox is not None and outbox.ws is None:
+            # it reconnected elsewhere (another worker), so its session
+            # here cannot be resumed any more; it has not left though
+            close_client(cid)
+        behind_link.add(cid)
+        known = published_topics[cid]
+        for address in topics:
+            if address not in known:
+                known.add(address)
+                mark_published(cid, address, link)
+
+
+def published_for(link):
+    # everything published here or behind other links that `link` may see
+    hidden = set()
+    for peer_id, cids in remote_clients.items():
+        source = peer_links.get(peer_id)
+        if source is None or not relays_to(source, link):
+            hidden.update(cids)
+
+    return {
+        cid: topics
+        for cid, topics in published_topics.items()
+        if cid not in hidden
+    }
+
+
+def drop_peer(link):
+    if peer_links.get(link.peer_id) is not link:
+        return
+
+    log.info("[PEER DOWN] %s", link.peer_id)
+    del peer_links[link.peer_id]
+    subscriptions.remove(link.peer_id)
+    announce_interest()
+
+    for cid in remote_clients.pop(link.peer_id, ()):
+        if published_topics.pop(cid, None) is not None:
+            mark_left(cid, link)
+
+
+async def read_peer_frames(reader):
+    while True:
+        size = int.from_bytes(await reader.readexactly(4), "big")
+        body = await reader.readexactly(size)
+        yield body[0], body[1:]
+
+
+async def handle_peer_osc(link, body):
+    path_end = 1 + body[0] * BROKER_ID_SIZE
+    path = body[1:path_end]
+    frame = body[path_end:]
+
+    if path_contains(path, BROKER_ID):
+        log.debug("Dropping looped frame from %s", link.peer_id)
+        return
+
+    try:
+        await handle_frame(
+            frame_origin(frame), frame,
+            source=link, put=relay_put(path + BROKER_ID)
+        )
+    except ValueError as e:
+        log.warning("Malformed frame from %s: %s", link.peer_id, e)
+
+
+async def run_peer_link(reader, writer, mesh):
+    hello = json.dumps({"name": BROKER_NAME, "broker": BROKER_ID.hex()})
+    hello = hello.encode()
+    writer.write((len(hello) + 1).to_bytes(4, "big") + bytes((PEER_HELLO,)))
+    writer.write(hello)
+
+    link = None
+    try:
+        async for kind, body in read_peer_frames(reader):
+            if kind == PEER_OSC:
+                await handle_peer_osc(link, body)
+
+            elif kind == PEER_HELLO:
+                data = json.loads(body)
+                link = PeerLink(
+                    data["name"], bytes.fromhex(data["broker"]), writer, mesh
+                )
+                peer_links[link.peer_id] = link
+                log.info("[PEER UP] %s", link.peer_id)
+
+                announce_interest()
+                send_peer_state([link], (), published_for(link))
+
+            elif kind == PEER_INTEREST:
+                subscriptions.set(link.peer_id, json.loads(body))
+                announce_interest()
+
+            elif kind == PEER_STATE:
+                apply_peer_state(link, json.loads(body))
+
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+
+    finally:
+        if link is not None:
+            drop_peer(link)
+        writer.close()
+
+
+async def keep_link(open_connection, mesh):
+    # (re)connects a link for as long as the broker runs
+    while True:
+        try:
+            reader, writer = await open_connection()
+        except OSError:
+            await asyncio.sleep(0.1 if mesh else 1)
+            continue
+
+        await run_peer_link(reader, writer, mesh)
+        await asyncio.sleep(0.5)
+
+
+def ipc_path(worker):
+    return os.path.join(IPC_DIR, f"netosc-{PORT}-{worker}.sock")
+
+
+async def start_worker_links(worker):
+    # every worker listens; the higher-numbered one of each pair connects
+    path = ipc_path(worker)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: run_peer_link(reader, writer, mesh=True),
+        path
+    )
+
+    loop = asyncio.get_running_loop()
+    for other in range(worker):
+        loop.create_task(keep_link(
+            lambda path=ipc_path(other): asyncio.open_unix_connection(path),
+            mesh=True
+        ))
+    return server
+
+
+async def start_federation():
+    server = None
+    if PEER_PORT is not None:
+        server = await asyncio.start_server(
+            lambda reader, writer: run_peer_link(reader, writer, mesh=False),
+            HOST,
+            PEER_PORT
+        )
+        log.info("Accepting broker links on %s:%s", HOST, PEER_PORT)
+
+    loop = asyncio.get_running_loop()
+    for peer in PEERS:
+        host, port = peer.rsplit(":", 1)
+        log.info("Linking to broker %s", peer)
+        loop.create_task(keep_link(
+            lambda host=host, port=int(port): asyncio.open_connection(
+                host, port
+            ),
+            mesh=False
+        ))
+    return server
+
+# =========================================================
+# UDP transport
+# =========================================================
+#
+# Clients that negotiated UDP get a token in their welcome message and
+# say hello with it from their UDP socket, which binds that address to
+# their connection until it is silent for UDP_TIMEOUT or the WebSocket
+# goes away. Their single OSC messages are then routed from and delivered
+# to that address; anything else, or anything that does not fit into
+# UDP_MAX_PACKET, stays on the WebSocket. Incoming datagrams are queued
+# and routed by one task like WebSocket frames, and a message older than
+# the last one routed for its address from the same client is dropped.
+
+class BrokerUDP(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.port = None
+        self.queue = deque()  # (client_id, datagram)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.port = transport.get_extra_info("sockname")[1]
+
+    def datagram_received(self, data, addr):
+        if not data:
+            return
+
+        if data[0] == UDP_OSC:
+            client_id = udp_clients.get(addr)
+            if client_id is None or len(data) <= UDP_HEADER_SIZE:
+                return
+            if len(self.queue) >= INGRESS_QUEUE_SIZE:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append((client_id, data))
+            self.ready.set()
+
+        elif data[0] == UDP_PING:
+            outbox = clients.get(udp_clients.get(addr))
+            if outbox is not None and outbox.udp is not None:
+                outbox.udp.seen()
+                self.transport.sendto(PING, addr)
+
+        elif data[0] == UDP_HELLO:
+            outbox = clients.get(udp_tokens.get(data[1:]))
+            if outbox is not None and outbox.ws is not None:
+                bind_udp(outbox, addr)
+                self.transport.sendto(data, addr)
+
+
+def udp_offer(outbox):
+    if outbox.udp_token is None:
+        return None
+    return {"port": udp_endpoint.port, "token": outbox.udp_token.hex()}
+
+
+def bind_udp(outbox, addr):
+    # A hello on a bound address keeps the sequence numbers going; a new
+    # binding starts over, and the client forgets what it received before
+    # once its hello is answered.
+    if outbox.udp is None or outbox.udp_addr != addr:
+        unbind_udp(outbox)
+        outbox.udp_addr = addr
+        outbox.udp = UDPPeer()
+        udp_clients[addr] = outbox.client_id
+        log.info("[UDP] %s bound to %s:%s", outbox.client_id, *addr[:2])
+    outbox.udp.seen()
+
+
+def unbind_udp(outbox):
+    if outbox.udp_addr is not None:
+        udp_clients.pop(outbox.udp_addr, None)
+    outbox.udp_addr = None
+    outbox.udp = None
+
+
+def forget_udp(outbox):
+    unbind_udp(outbox)
+    if outbox.udp_token is not None:
+        udp_tokens.pop(outbox.udp_token, None)
+        outbox.udp_token = None
+
+
+async def route_udp(endpoint):
+    while True:
+        await endpoint.ready.wait()
+        while endpoint.queue:
+            client_id, data = endpoint.queue.popleft()
+            outbox = clients.get(client_id)
+            if outbox is None or outbox.udp is None:
+                continue
+
+            outbox.udp.seen()
+            outbox.udp.received += 1
+            seq, packet = unpack_osc(data)
+            try:
+                if not packet.startswith(BUNDLE_PREFIX):
+                    address = routing_addresses(packet, 0, len(packet))[0][0]
+                    if not outbox.udp.streams.fresh(address, seq):
+                        continue
+                await handle_frame(
+                    client_id, pack_frame(outbox.origin, packet)
+                )
+            except ValueError as e:
+                log.warning("Malformed datagram from %s: %s", client_id, e)
+        endpoint.ready.clear()
+
+
+async def expire_udp():
+    while True:
+        await asyncio.sleep(UDP_KEEPALIVE)
+        for outbox in list(clients.values()):
+            if outbox.udp is not None and outbox.udp.timed_out():
+                log.info("[UDP] %s timed out", outbox.client_id)
+                unbind_udp(outbox)
+
+
+async def start_udp(port):
+    global udp_endpoint
+
+    loop = asyncio.get_running_loop()
+    _, udp_endpoint = await loop.create_datagram_endpoint(
+        BrokerUDP, local_addr=(HOST, port)
+    )
+    loop.create_task(route_udp(udp_endpoint))
+    loop.create_task(expire_udp())
+    log.info("UDP transport on %s:%s", HOST, udp_endpoint.port)
 
 # =========================================================
 # Message handling
 # =========================================================
 
+def parse_topics(topics):
+    # Topics are pattern strings or objects with options:
+    #
+    #   {"pattern": "/fader/*", "latest": true, "rate": 20}
+    #
+    # "rate" (messages/s) or "interval" (s) limit how often each matching
+    # address is sent. An address matched by any of a client's latest-only
+    # patterns is conflated.
+    patterns = []
+    latest = []
+    limits = {}
+    for topic in topics:
+        if isinstance(topic, str):
+            topic = {"pattern": topic}
+
+        pattern = topic["pattern"]
+        patterns.append(pattern)
+        if topic.get("latest"):
+            latest.append(pattern)
+
+        interval = topic.get("interval", 0)
+        if topic.get("rate"):
+            interval = max(interval, 1 / topic["rate"])
+        limits[pattern] = min(limits.get(pattern, interval), interval)
+
+    return patterns, latest, limits
+
+
 async def handle_subscribe(client_id, data):
     topics = data.get("topics", [])
-    subscriptions[client_id] = topics
-    print(f"[SUBSCRIBE] {client_id} → {topics}")
+    patterns, latest, limits = parse_topics(topics)
+    previous = subscriptions.patterns.get(client_id, [])
+    subscriptions.set(client_id, patterns)
+    latest_subscriptions.set(client_id, latest)
+    limited_subscriptions.set(
+        client_id, [p for p, interval in limits.items() if interval > 0]
+    )
+    log.info("[SUBSCRIBE] %s → %s", client_id, topics)
+    announce_interest()
+
+    # clients list the formats they understand in order of preference
+    outbox = clients[client_id]
+    outbox.set_limits(limits)
+    offered = data.get("formats", [FORMAT_JSON])
+    outbox.format = next(
+        (f for f in offered if f in WIRE_FORMATS), FORMAT_JSON
+    )
+    outbox.aliases = (
+        ALIASES and outbox.format == FORMAT_BINARY
+        and bool(data.get("aliases"))
+    )
+    if SESSION_GRACE > 0 and outbox.session is None:
+        outbox.session = secrets.token_hex(16)
+    if (udp_endpoint is not None and outbox.format == FORMAT_BINARY
+            and data.get("udp")):
+        if outbox.udp_token is None:
+            outbox.udp_token = secrets.token_bytes(TOKEN_SIZE)
+            udp_tokens[outbox.udp_token] = client_id
+    else:
+        forget_udp(outbox)
+    outbox.put(
+        json.dumps({
+            "type": "welcome",
+            "format": outbox.format,
+            "aliases": outbox.aliases,
+            "session": outbox.session,
+            "udp": udp_offer(outbox),
+        }),
+        control=True
+    )
+    push_retained(
+        client_id, outbox, [p for p in patterns if p not in previous]
+    )
+
+
+def push_retained(client_id, outbox, patterns):
+    # Current values for newly subscribed patterns, as one batch frame
+    # (more only if they exceed RETAIN_FRAME_BYTES). Like live traffic, a
+    # client does not get back what it published itself.
+    if not patterns or not retained.values:
+        return
+
+    origin = origin_uuid(client_id)
+    messages = [
+        message for message in retained.matching(patterns)
+        if message.origin != origin
+    ]
+
+    chunk = []
+    size = 0
+    for message in messages:
+        chunk.append(plain_frame(message.frame_for(outbox)))
+        size += len(chunk[-1])
+        if size >= RETAIN_FRAME_BYTES or message is messages[-1]:
+            outbox.put(
+                chunk[0] if len(chunk) == 1 else join_frames(chunk),
+                control=True
+            )
+            chunk = []
+            size = 0
+
+    if messages:
+        log.info("[RETAINED] %s ← %d values", client_id, len(messages))
+
+
+def note_published(client_id, address):
+    topics = published_topics[client_id]
+    if address not in topics:
+        topics.add(address)
+        mark_published(client_id, address)
 
-async def handle_osc(client_id, data):
-    address = data["address"]
-    args = data["args"]
 
-    published_topics[client_id].add(address)
+def put_frame(outbox, frame):
+    outbox.put(frame)
 
-    print(f"[OSC IN] {client_id} | {address} {args}")
 
-    # Relay to interested clients
-    for target_id, target_ws in clients.items():
+def deliver(outbox, message, latest, put):
+    # Over UDP when the subscriber has it and the packet fits; traced
+    # messages stay on the WebSocket, which is where the trace is collected
+    if outbox.udp is not None and message.trace is None:
+        packet = message.packet
+        if packet is None:
+            packet = memoryview(message.binary_frame())[FRAME_HEADER_SIZE:]
+        if len(packet) <= UDP_MAX_PACKET:
+            outbox.send_udp(packet)
+            return
+
+    if latest:
+        outbox.put_latest(message.address, message.frame_for(outbox))
+    else:
+        put(outbox, message.frame_for(outbox))
+
+
+async def handle_osc(client_id, message, put=put_frame, source=None):
+    started = time.perf_counter()
+    address = message.address
+    if source is None:
+        note_published(client_id, address)
+    retained.store(message)
+
+    if traffic.every and traffic.sample(address):
+        if message.packet is not None:
+            traffic_log.info(
+                "[OSC IN] %s | %s (%d bytes)",
+                client_id, address, len(message.packet)
+            )
+        else:
+            traffic_log.info(
+                "[OSC IN] %s | %s %s", client_id, address, message.json_args
+            )
+
+    # Relay to interested clients; each frame format is encoded at most
+    # once and handed to the subscriber's queue without waiting for the send
+    latest = (
+        latest_subscriptions.match(address)
+        if latest_subscriptions.patterns else ()
+    )
+    limited = (
+        limited_subscriptions.match(address)
+        if limited_subscriptions.patterns else ()
+    )
+    fanout = 0
+    for target_id in subscriptions.match(address):
         if target_id == client_id:
             continue
 
-        for pattern in subscriptions.get(target_id, []):
-            if topic_matches(address, pattern):
-                msg = {
-                    "type": "osc",
-                    "address": address,
-                    "args": args
-                }
-                await target_ws.send(json.dumps(msg))
-                break
+        outbox = target_outbox(target_id, source)
+        if outbox is None:
+            continue
+
+        if target_id in limited and not outbox.allow(address):
+            continue
+
+        deliver(outbox, message, target_id in latest, put)
+        fanout += 1
 
-    await broadcast_state()
+    metrics.record_route(
+        client_id, address, fanout, time.perf_counter() - started
+    )
+
+
+async def handle_packet(client_id, buffer, start, end, frame=None,
+                        put=put_frame, source=None, trace=None):
+    # Binary packets are routed on the OSC address(es) alone; arguments are
+    # never decoded unless a JSON subscriber needs them. frame is the
+    # received frame when it carries nothing but this packet. Clients only
+    # trace single messages, so the trace is not carried into bundles.
+    elements = routing_addresses(buffer, start, end)
+    view = memoryview(buffer)
+    origin = buffer[1:FRAME_HEADER_SIZE]
+
+    if not buffer.startswith(BUNDLE_PREFIX, start):
+        address = elements[0][0]
+        await handle_osc(
+            client_id,
+            RelayMessage(
+                address, origin, view[start:end], frame=frame, trace=trace
+            ),
+            put,
+            source
+        )
+        return
+
+    await handle_bundle(
+        client_id,
+        RelayMessage("#bundle", origin, view[start:end], frame=frame),
+        [
+            RelayMessage(address, origin, view[element_start:element_end])
+            for address, element_start, element_end in elements
+        ],
+        put,
+        source
+    )
+
+
+async def handle_bundle(client_id, bundle, messages, put=put_frame,
+                        source=None):
+    # Binary subscribers that want every element get the bundle unchanged;
+    # everyone else gets the elements they subscribed to one by one. In the
+    # metrics every element counts as a message, with an equal share of the
+    # routing time.
+    started = time.perf_counter()
+    fanouts = [0] * len(messages)
+
+    if traffic.every and traffic.sample("#bundle"):
+        traffic_log.info(
+            "[OSC IN] %s | bundle of %d", client_id, len(messages)
+        )
+
+    target_sets = []
+    latest_sets = []
+    limited_sets = []
+    for message in messages:
+        if source is None:
+            note_published(client_id, message.address)
+        retained.store(message)
+        target_sets.append(subscriptions.match(message.address))
+        latest_sets.append(
+            latest_subscriptions.match(message.address)
+            if latest_subscriptions.patterns else ()
+        )
+        limited_sets.append(
+            limited_subscriptions.match(message.address)
+            if limited_subscriptions.patterns else ()
+        )
+
+    for target_id in frozenset().union(*target_sets):
+        if target_id == client_id:
+            continue
+
+        outbox = target_outbox(target_id, source)
+        if outbox is None:
+            continue
+
+        if outbox.format == FORMAT_BINARY and all(
+            target_id in targets
+            and target_id not in latest
+            and target_id not in limited
+            for targets, latest, limited
+            in zip(target_sets, latest_sets, limited_sets)
+        ):
+            if (outbox.udp is not None
+                    and len(bundle.packet) <= UDP_MAX_PACKET):
+                outbox.send_udp(bundle.packet)
+            else:
+                put(outbox, bundle.binary_frame())
+            for i in range(len(fanouts)):
+                fanouts[i] += 1
+            continue
+
+        for i, (message, targets, latest, limited) in enumerate(zip(
+            messages, target_sets, latest_sets, limited_sets
+        )):
+            if target_id not in targets:
+                continue
+            if target_id in limited and not outbox.allow(message.address):
+                continue
+            deliver(outbox, message, target_id in latest, put)
+            fanouts[i] += 1
+
+    elapsed = (time.perf_counter() - started) / max(len(messages), 1)
+    for message, fanout in zip(messages, fanouts):
+        metrics.record_route(client_id, message.address, fanout, elapsed)
+
+
+async def handle_frame(client_id, frame, source=None, put=put_frame):
+    if frame[0] in (FRAME_ALIAS, FRAME_ALIAS_BIND):
+        # routed like a regular frame, which non-aliased subscribers need
+        outbox = clients.get(client_id)
+        if outbox is None:
+            raise ValueError("aliased frame without a client")
+        frame = pack_frame(
+            outbox.origin, alias_packet(outbox.aliases_in, frame)
+        )
+
+    ranges = frame_ranges(frame)
+
+    if frame[0] == FRAME_OSC:
+        start, end = ranges[0]
+        await handle_packet(
+            client_id, frame, start, end, frame=frame, put=put, source=source
+        )
+        return
+
+    if frame[0] & FRAME_TRACE:
+        trace = read_trace(frame)
+        trace["stamps"].append([HOP_BROKER_IN, time.time()])
+        start, end = ranges[0]
+        await handle_packet(
+            client_id, frame, start, end, put=put, source=source, trace=trace
+        )
+        return
+
+    pending = defaultdict(list)
+    for start, end in ranges:
+        await handle_packet(
+            client_id, frame, start, end,
+            put=lambda outbox, f: pending[outbox].append(f),
+            source=source
+        )
+    flush_batch(pending, put)
+
+
+async def handle_batch(client_id, data):
+    pending = defaultdict(list)
+    origin = origin_uuid(client_id)
+
+    for msg in data["messages"]:
+        await handle_osc(
+            client_id,
+            RelayMessage(msg["address"], origin, json_args=msg["args"]),
+            put=lambda outbox, f: pending[outbox].append(f)
+        )
+    flush_batch(pending)
+
+
+def flush_batch(pending, put=put_frame):
+    # A batch from a publisher goes out as one batch frame per subscriber.
+    # Subscribers that receive the same frames share one encoding.
+    joined = {}
+
+    for outbox, frames in pending.items():
+        if len(frames) == 1:
+            put(outbox, frames[0])
+            continue
+
+        key = tuple(map(id, frames))
+        batch = joined.get(key)
+        if batch is None:
+            batch = joined[key] = join_frames(list(map(plain_frame, frames)))
+        put(outbox, batch)
 
 # =========================================================
 # Client lifecycle
 # =========================================================
 
+def register_client(client_id, ws):
+    outbox = clients.get(client_id)
+    if outbox is not None and outbox.ws is ws:
+        return
+
+    if outbox is not None:
+        outbox.close()
+    clients[client_id] = Outbox(client_id, ws)
+
+
+def drop_client(client_id):
+    close_client(client_id)
+    if published_topics.pop(client_id, None) is not None:
+        mark_left(client_id)
+
+
+def close_client(client_id):
+    # ends the connection or session, but keeps what it published
+    outbox = clients.pop(client_id)
+    outbox.close()
+    log.info(
+        "[DISCONNECT] %s (sent %d, dropped %d)",
+        client_id, outbox.sent, outbox.dropped
+    )
+
+    subscriptions.remove(client_id)
+    latest_subscriptions.remove(client_id)
+    limited_subscriptions.remove(client_id)
+    metrics.forget_client(client_id)
+    announce_interest()
+
+# Sessions
+#
+# A client that loses its connection is detached rather than dropped when
+# it has a session: its subscriptions, published addresses and send queue
+# stay as they are, so nobody else notices a short network blip. If it
+# sends "resume" with its token within SESSION_GRACE, the queue continues
+# on the new connection, state deltas included. Otherwise the session
+# expires and the client is dropped like any other. With --workers a
+# client that reconnects to a different worker cannot resume and
+# subscribes again; its old worker drops the session as soon as it hears
+# about the client from the new one.
+
+def detach_client(client_id, outbox):
+    outbox.detach()
+    outbox.expiry = asyncio.get_running_loop().call_later(
+        SESSION_GRACE, expire_session, client_id, outbox
+    )
+    log.info(
+        "[DETACH] %s (session kept for %gs)", client_id, SESSION_GRACE
+    )
+
+
+def expire_session(client_id, outbox):
+    if clients.get(client_id) is outbox and outbox.ws is None:
+        drop_client(client_id)
+
+
+def resume_client(client_id, session, ws):
+    outbox = clients.get(client_id)
+    if outbox is None or session is None or outbox.session != session:
+        return False
+
+    outbox.attach(ws)
+    log.info("[RESUME] %s (%d queued)", client_id, len(outbox.queue) - 1)
+    return True
+
+
 async def handle_client(ws):
     client_id = None
+    log.info("[CONNECT] %s", ws.remote_address)
 
     try:
         async for message in ws:
+            if isinstance(message, bytes):
+                if client_id is None:
+                    if message[0] in (FRAME_ALIAS, FRAME_ALIAS_BIND):
+                        log.warning("Aliased frame before subscribe")
+                        continue
+                    client_id = frame_origin(message)
+                    register_client(client_id, ws)
+
+                try:
+                    await handle_frame(client_id, message)
+                except ValueError as e:
+                    log.warning("Malformed frame from %s: %s", client_id, e)
+                continue
+
             data = json.loads(message)
             msg_type = data.get("type")
 
             if msg_type == "subscribe":
                 client_id = data["client_id"]
-                clients[client_id] = ws
+                register_client(client_id, ws)
                 await handle_subscribe(client_id, data)
-                await broadcast_state()
+                send_state_snapshot(client_id)
 
-            elif msg_type == "osc":
+            elif msg_type in ("osc", "batch"):
+                # the connection identifies the sender; clients only name
+                # themselves if they publish before subscribing
                 if client_id is None:
-                    client_id = data["client_id"]
-                    clients[client_id] = ws
+                    client_id = data.get("client_id")
+                    if client_id is None:
+                        log.warning("Anonymous %s message ignored", msg_type)
+                        continue
+                    register_client(client_id, ws)
+
+                if msg_type == "batch":
+                    await handle_batch(client_id, data)
+                else:
+                    trace = data.get("trace")
+                    if trace is not None:
+                        trace["stamps"].append([HOP_BROKER_IN, time.time()])
 
-                await handle_osc(client_id, data)
+                    await handle_osc(
+                        client_id,
+                        RelayMessage(
+                            data["address"],
+                            origin_uuid(client_id),
+                            json_args=data["args"],
+                            trace=trace
+                        )
+                    )
+
+            elif msg_type == "resume":
+                client_id = data["client_id"]
+                if not resume_client(client_id, data.get("session"), ws):
+                    client_id = None
+                    await ws.send(json.dumps({"type": "resume_failed"}))
+
+            elif msg_type == "resync":
+                send_state_snapshot(client_id)
+
+            elif msg_type == "stats":
+                await ws.send(json.dumps({
+                    "type": "stats",
+                    "queues": queue_stats(),
+                    "peers": peer_stats(),
+                    "metrics": metrics.snapshot(),
+                    "retained": retained.stats(),
+                }))
 
             else:
-                print(f"[WARN] Unknown message type: {msg_type}")
+                log.warning("Unknown message type: %s", msg_type)
 
     except websockets.exceptions.ConnectionClosed:
         pass
 
     finally:
-        if client_id:
-            print(f"[DISCONNECT] {client_id}")
-            clients.pop(client_id, None)
-            subscriptions.pop(client_id, None)
-            published_topics.pop(client_id, None)
-            await broadcast_state()
+        outbox = clients.get(client_id)
+
+        # unless the client already reconnected on another connection
+        if outbox is not None and outbox.ws is ws:
+            if SESSION_GRACE > 0 and outbox.session is not None:
+                detach_client(client_id, outbox)
+            else:
+                drop_client(client_id)
 
 # =========================================================
 # Main
 # =========================================================
 
-async def main():
-    print(f"Starting netOSC server on {HOST}:{PORT}")
-    async with websockets.serve(handle_client, HOST, PORT):
+async def main(worker=None):
+    global WORKER_NAME, BROKER_NAME, BROKER_ID
+
+    BROKER_ID = uuid.uuid4().bytes
+    if BROKER_NAME is None:
+        BROKER_NAME = f"{socket.gethostname()}:{PORT}"
+    if worker is not None:
+        WORKER_NAME = f"worker-{worker}"
+        BROKER_NAME = f"{BROKER_NAME}/{WORKER_NAME}"
+
+    setup_logging(LOG_LEVEL, TRAFFIC_LOG_SAMPLE, WORKER_NAME)
+    serve_options = {}
+    retained.set_patterns(RETAIN_PATTERNS)
+    schedule_state_flush()
+
+    asyncio.get_running_loop().create_task(metrics.watch())
+    if METRICS_PORT is not None:
+        metrics_port = METRICS_PORT + (worker or 0)
+        await serve_metrics(HOST, metrics_port, metrics_page)
+        log.info("Metrics on http://%s:%s/metrics", HOST, metrics_port)
+
+    if UDP_PORT is not None:
+        await start_udp(UDP_PORT + (worker or 0))
+
+    # in multi-process mode only the first worker links to other brokers
+    if worker in (None, 0):
+        await start_federation()
+
+    if worker is not None:
+        await start_worker_links(worker)
+        serve_options["reuse_port"] = True
+        log.info(
+            "Starting netOSC worker %d/%d on %s:%s",
+            worker + 1, WORKERS, HOST, PORT
+        )
+    else:
+        log.info("Starting netOSC server on %s:%s", HOST, PORT)
+
+    async with websockets.serve(handle_client, HOST, PORT, **serve_options):
         await asyncio.Future()  # run forever
 
+
+def run_worker(worker, options):
+    globals().update(options)
+    asyncio.run(main(worker))
+
+
+def run_workers():
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=(worker, {
+                "HOST": HOST,
+                "PORT": PORT,
+                "WORKERS": WORKERS,
+                "BROKER_NAME": BROKER_NAME,
+                "PEER_PORT": PEER_PORT,
+                "PEERS": PEERS,
+                "METRICS_PORT": METRICS_PORT,
+                "RETAIN_PATTERNS": RETAIN_PATTERNS,
+                "UDP_PORT": UDP_PORT,
+            }),
+            name=f"worker-{worker}"
+        )
+        for worker in range(WORKERS)
+    ]
+
+    for process in processes:
+        process.start()
+
+    # take the workers down with the parent, also when it is terminated
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="netOSC broker")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--workers", type=int, default=WORKERS,
+        help="worker processes sharing the port (default: 1)"
+    )
+    parser.add_argument(
+        "--name", default=BROKER_NAME,
+        help="name announced to linked brokers (default: <hostname>:<port>)"
+    )
+    parser.add_argument(
+        "--peer-port", type=int, default=PEER_PORT,
+        help="accept links from other brokers on this port"
+    )
+    parser.add_argument(
+        "--peer", action="append", default=list(PEERS), metavar="HOST:PORT",
+        help="link to another broker's peer port (repeatable)"
+    )
+    parser.add_argument(
+        "--retain", action="append", default=list(RETAIN_PATTERNS),
+        metavar="PATTERN",
+        help="keep the last value of matching addresses for new "
+             "subscribers (repeatable)"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=METRICS_PORT,
+        help="serve Prometheus metrics over HTTP on this port"
+    )
+    parser.add_argument(
+        "--udp-port", type=int, default=UDP_PORT,
+        help="relay OSC messages of clients that ask for it over UDP "
+             "on this port"
+    )
+    args = parser.parse_args()
+
+    HOST, PORT, WORKERS = args.host, args.port, args.workers
+    BROKER_NAME, PEER_PORT, PEERS = args.name, args.peer_port, args.peer
+    METRICS_PORT, UDP_PORT = args.metrics_port, args.udp_port
+    RETAIN_PATTERNS = args.retain
+
+    if WORKERS > 1:
+        run_workers()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,92 @@
+import time
+
+# =========================================================
+# netOSC UDP transport
+# =========================================================
+#
+# Optional datagram path for OSC traffic between a client and the broker,
+# next to the WebSocket, which keeps carrying everything else (subscribe,
+# state, batches, traced messages). A lost datagram only loses its own
+# message instead of holding up every later one until TCP retransmits it.
+#
+# The broker hands out a token in its welcome message. The client sends
+# it in a hello datagram, which binds the client's UDP address to its
+# connection, and the broker echoes the hello back. Both sides then
+# exchange pings every UDP_KEEPALIVE seconds; a side that hears nothing
+# for UDP_TIMEOUT seconds falls back to the WebSocket (and the client
+# says hello again).
+#
+#   UDP_HELLO | token (16 bytes)
+#   UDP_PING
+#   UDP_OSC   | sequence number (4 bytes) | OSC packet
+#
+# Every sender numbers its OSC datagrams. A receiver drops a message
+# that is older than the last one it delivered for the same address, so
+# a late update never overwrites a newer one.
+
+UDP_HELLO = 0x10
+UDP_PING = 0x11
+UDP_OSC = 0x12
+UDP_HEADER_SIZE = 5
+
+UDP_KEEPALIVE = 1.0
+UDP_TIMEOUT = 3.0
+UDP_MAX_PACKET = 1200  # larger packets go over the WebSocket
+
+TOKEN_SIZE = 16
+PING = bytes((UDP_PING,))
+STALE_FILTER_SIZE = 4096  # addresses tracked before starting over
+
+
+def pack_hello(token):
+    return bytes((UDP_HELLO,)) + token
+
+
+def pack_osc(seq, packet):
+    return b"".join(
+        (bytes((UDP_OSC,)), (seq & 0xFFFFFFFF).to_bytes(4, "big"), packet)
+    )
+
+
+def unpack_osc(datagram):
+    # returns (sequence number, OSC packet)
+    seq = int.from_bytes(datagram[1:UDP_HEADER_SIZE], "big")
+    return seq, datagram[UDP_HEADER_SIZE:]
+
+
+class StaleFilter:
+    def __init__(self, size=STALE_FILTER_SIZE):
+        self.size = size
+        self.last = {}  # address -> newest sequence number delivered
+        self.stale = 0
+
+    def fresh(self, address, seq):
+        last = self.last.get(address)
+        if last is not None and seq <= last:
+            self.stale += 1
+            return False
+
+        if last is None and len(self.last) >= self.size:
+            self.last.clear()
+        self.last[address] = seq
+        return True
+
+
+class UDPPeer:
+    # send and receive state of one UDP association
+    def __init__(self):
+        self.seq = 0
+        self.last_seen = time.monotonic()
+        self.streams = StaleFilter()
+        self.sent = 0
+        self.received = 0
+
+    def next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    def seen(self):
+        self.last_seen = time.monotonic()
+
+    def timed_out(self):
+        return time.monotonic() - self.last_seen > UDP_TIMEOUT
@@ -0,0 +1,320 @@
+import base64
+import struct
+import uuid
+import zlib
+
+from pythonosc.osc_message import OscMessage
+from pythonosc.osc_message_builder import OscMessageBuilder
+
+# =========================================================
+# netOSC wire format
+# =========================================================
+#
+# Control messages (subscribe, state, ...) are JSON text frames. OSC traffic
+# is either JSON ({"type": "osc", ...}) or, when both sides negotiated it,
+# a binary frame carrying the original OSC datagram untouched:
+#
+#   kind (1 byte) | origin client id (16 byte UUID) | OSC packet
+#
+# The same layout is used in both directions, so the broker can forward a
+# publisher's frame to binary subscribers without rebuilding it. Routing
+# reads the address straight from the OSC packet (see routing_addresses).
+#
+# Batch frames pack several OSC packets into one WebSocket frame:
+#
+#   kind | origin client id | (size (4 bytes) | OSC packet) ...
+#
+# The JSON counterpart is {"type": "batch", "messages": [...]}.
+#
+# Traced messages (see Tracing below) set FRAME_TRACE on the kind and put a
+# trace block between the origin and the OSC packet:
+#
+#   kind | origin | block size (2 bytes) | trace block | OSC packet
+#
+# Connections that negotiated aliases (see Aliases below) send single
+# messages without origin and address, as a 2-byte alias id instead.
+
+FORMAT_BINARY = "binary"
+FORMAT_JSON = "json"
+
+FRAME_OSC = 0x01
+FRAME_BATCH = 0x02
+FRAME_ALIAS = 0x03
+FRAME_ALIAS_BIND = 0x04
+FRAME_TRACE = 0x80
+FRAME_HEADER_SIZE = 17
+
+NO_ORIGIN = bytes(16)
+
+BUNDLE_PREFIX = b"#bundle\0"
+
+
+def origin_uuid(client_id):
+    try:
+        return uuid.UUID(client_id).bytes
+    except ValueError:
+        return NO_ORIGIN
+
+
+def pack_frame(origin, packet):
+    return b"".join((bytes((FRAME_OSC,)), origin, packet))
+
+
+def pack_batch(origin, packets):
+    parts = [bytes((FRAME_BATCH,)), origin]
+    for packet in packets:
+        parts.append(len(packet).to_bytes(4, "big"))
+        parts.append(packet)
+    return b"".join(parts)
+
+
+def frame_origin(frame):
+    return str(uuid.UUID(bytes=frame[1:FRAME_HEADER_SIZE]))
+
+
+def frame_ranges(frame):
+    # returns [(start, end)] of the OSC packets carried by a binary frame
+    kind = frame[0]
+
+    if kind == FRAME_OSC:
+        return [(FRAME_HEADER_SIZE, len(frame))]
+
+    if kind == FRAME_OSC | FRAME_TRACE:
+        return [(trace_end(frame), len(frame))]
+
+    if kind != FRAME_BATCH:
+        raise ValueError(f"unknown frame kind {kind}")
+
+    ranges = []
+    index = FRAME_HEADER_SIZE
+    while index + 4 <= len(frame):
+        size = int.from_bytes(frame[index:index + 4], "big")
+        index += 4
+        if index + size > len(frame):
+            raise ValueError("batch element exceeds frame")
+        ranges.append((index, index + size))
+        index += size
+
+    return ranges
+
+
+def join_frames(frames):
+    # combines single-message frames for one receiver into one batch frame
+    if isinstance(frames[0], str):
+        return '{"type": "batch", "messages": [' + ", ".join(frames) + "]}"
+
+    return pack_batch(
+        frames[0][1:FRAME_HEADER_SIZE],
+        [memoryview(frame)[FRAME_HEADER_SIZE:] for frame in frames]
+    )
+
+# =========================================================
+# Aliases
+# =========================================================
+#
+# Each side of a connection numbers the addresses it sends. The first
+# frame for an address binds its number, later ones carry only the
+# number and the rest of the OSC message (type tags and arguments):
+#
+#   FRAME_ALIAS_BIND | alias (2 bytes) | OSC message
+#   FRAME_ALIAS      | alias (2 bytes) | OSC message without its address
+#
+# The receiver keeps alias -> address per connection. Frames of one
+# connection arrive in order, so a bind always precedes its use; both
+# tables start over when the connection is re-established. Bundles,
+# batches and traced messages keep the regular frames.
+
+ALIAS_HEADER_SIZE = 3
+MAX_ALIASES = 0x10000
+
+
+def address_end(packet):
+    # index after the null-padded address of an OSC message
+    return (packet.index(b"\0") // 4 + 1) * 4
+
+
+def pack_alias_bind(alias, packet):
+    return b"".join(
+        (bytes((FRAME_ALIAS_BIND,)), alias.to_bytes(2, "big"), packet)
+    )
+
+
+def pack_alias(alias, rest):
+    # rest: the OSC message from its type tags on
+    return b"".join((bytes((FRAME_ALIAS,)), alias.to_bytes(2, "big"), rest))
+
+
+def alias_packet(aliases, frame):
+    # Returns the OSC message of an aliased frame. aliases maps the
+    # sender's alias ids to padded addresses and learns from binds.
+    alias = int.from_bytes(frame[1:ALIAS_HEADER_SIZE], "big")
+
+    if frame[0] == FRAME_ALIAS_BIND:
+        packet = frame[ALIAS_HEADER_SIZE:]
+        aliases[alias] = bytes(packet[:address_end(packet)])
+        return packet
+
+    address = aliases.get(alias)
+    if address is None:
+        raise ValueError(f"unknown alias {alias}")
+    return address + frame[ALIAS_HEADER_SIZE:]
+
+# =========================================================
+# Tracing
+# =========================================================
+#
+# A traced message collects a wall-clock stamp at every hop it passes:
+#
+#   client_in       packet taken from UDP by the publishing client
+#   client_out      frame encoded and handed to the WebSocket
+#   broker_in       frame received by a broker
+#   broker_queued   frame queued for a subscriber (or a linked broker)
+#   broker_out      frame handed to that subscriber's connection
+#   client_ws_in    frame received by the subscribing client
+#   client_udp_out  packet sent to the client's OSC target
+#
+# Wall-clock time, so stamps from different hosts can be compared (to the
+# accuracy of their clock sync). Clients pick the messages to trace by a
+# checksum of the OSC packet, which makes every hop that sees the same
+# bytes pick the same messages. The trace is {"id": <checksum>, "stamps":
+# [[hop, time], ...]}; in binary frames it is packed as:
+#
+#   id (4 bytes) | count (1 byte) | (hop (1 byte) | time (double)) ...
+
+TRACE_HOPS = (
+    "client_in",
+    "client_out",
+    "broker_in",
+    "broker_queued",
+    "broker_out",
+    "client_ws_in",
+    "client_udp_out",
+)
+(
+    HOP_CLIENT_IN,
+    HOP_CLIENT_OUT,
+    HOP_BROKER_IN,
+    HOP_BROKER_QUEUED,
+    HOP_BROKER_OUT,
+    HOP_CLIENT_WS_IN,
+    HOP_CLIENT_UDP_OUT,
+) = range(len(TRACE_HOPS))
+
+TRACE_STAMP = struct.Struct(">Bd")
+TRACE_BLOCK_START = FRAME_HEADER_SIZE + 2
+
+
+def trace_id(packet):
+    return zlib.crc32(packet)
+
+
+def pack_traced_frame(origin, packet, trace):
+    stamps = trace["stamps"]
+    block = [trace["id"].to_bytes(4, "big"), bytes((len(stamps),))]
+    block.extend(TRACE_STAMP.pack(hop, stamp) for hop, stamp in stamps)
+    block = b"".join(block)
+
+    return b"".join((
+        bytes((FRAME_OSC | FRAME_TRACE,)),
+        origin,
+        len(block).to_bytes(2, "big"),
+        block,
+        packet
+    ))
+
+
+def trace_end(frame):
+    # index of the OSC packet in a traced frame
+    size = int.from_bytes(frame[FRAME_HEADER_SIZE:TRACE_BLOCK_START], "big")
+    return TRACE_BLOCK_START + size
+
+
+def read_trace(frame):
+    index = TRACE_BLOCK_START
+    stamps = []
+    for i in range(frame[index + 4]):
+        offset = index + 5 + i * TRACE_STAMP.size
+        stamps.append(list(TRACE_STAMP.unpack_from(frame, offset)))
+
+    trace_id = int.from_bytes(frame[index:index + 4], "big")
+    return {"id": trace_id, "stamps": stamps}
+
+# =========================================================
+# OSC packets
+# =========================================================
+
+def iter_messages(packet):
+    # yields the raw OSC messages of a packet, flattening bundles
+    if not packet.startswith(BUNDLE_PREFIX):
+        yield packet
+        return
+
+    index = 16  # "#bundle\0" + 8 byte time tag
+    while index + 4 <= len(packet):
+        size = int.from_bytes(packet[index:index + 4], "big")
+        index += 4
+        yield from iter_messages(packet[index:index + size])
+        index += size
+
+
+def message_address(packet):
+    return packet[:packet.index(b"\0")].decode()
+
+
+def routing_addresses(buffer, start=0, end=None):
+    # Returns [(address, start, end)] for every message in the packet at
+    # buffer[start:end], descending into bundles. Only the address strings
+    # are read; type tags and arguments are skipped using the element sizes,
+    # so the cost does not depend on the payload size.
+    if end is None:
+        end = len(buffer)
+
+    if not buffer.startswith(BUNDLE_PREFIX, start):
+        null = buffer.find(b"\0", start, end)
+        if null < 0:
+            raise ValueError("OSC address is not terminated")
+        return [(buffer[start:null].decode(), start, end)]
+
+    found = []
+    index = start + 16  # "#bundle\0" + 8 byte time tag
+    while index + 4 <= end:
+        size = int.from_bytes(buffer[index:index + 4], "big")
+        index += 4
+        if index + size > end:
+            raise ValueError("OSC bundle element exceeds packet")
+        found.extend(routing_addresses(buffer, index, index + size))
+        index += size
+
+    return found
+
+
+def decode_args(packet):
+    return OscMessage(bytes(packet)).params
+
+
+def encode_message(address, args):
+    builder = OscMessageBuilder(address)
+    for arg in args:
+        builder.add_arg(arg)
+    return builder.build().dgram
+
+# =========================================================
+# JSON arguments
+# =========================================================
+#
+# JSON has no bytes type, so OSC blobs travel as {"blob": "<base64>"}.
+
+def to_json_args(args):
+    return [
+        {"blob": base64.b64encode(arg).decode()}
+        if isinstance(arg, bytes) else arg
+        for arg in args
+    ]
+
+
+def from_json_args(args):
+    return [
+        base64.b64decode(arg["blob"])
+        if isinstance(arg, dict) else arg
+        for arg in args
+    ]
@@ -0,0 +1,389 @@
+import asyncio
+import csv
+import json
+import os
+import random
+import struct
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import websockets
+
+from netosc_patterns import pattern_matches
+from netosc_wire import FORMAT_BINARY, frame_ranges, pack_frame
+from osc_latency import LatencyHistogram
+from osc_tester import encode_probe, load_dataset, read_probe
+
+# =========================================================
+# Configuration
+# =========================================================
+#
+# Starts a local netosc_server per configuration and drives it with
+# simulated WebSocket clients: publishers replaying the test dataset and
+# subscribers with a mix of pattern kinds. Reports delivered throughput,
+# end-to-end latency, and the broker's CPU and memory use, and appends
+# one row per configuration to RESULTS_FILE (plotted by
+# test-results/plots.py).
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8865
+SERVER_ARGS = []  # extra netosc_server.py arguments, e.g. ["--workers", "2"]
+
+DATASET_FILE = "netosc_test_dataset.jsonl"
+RESULTS_FILE = "test-results/bench_results.csv"
+RUN_LABEL = "netOSC"
+
+DURATION_SECONDS = 10
+STARTUP_SECONDS = 2.0  # clients connect and subscribe before the first send
+DRAIN_SECONDS = 2.0  # subscribers keep listening after the last send
+
+# Simulated clients are spread over this many processes
+CLIENT_PROCESSES = 2
+
+# Subscriber pattern kinds:
+#   "exact"   one dataset address ("/foo/x")
+#   "prefix"  the first characters of one ("/fo*")
+#   "all"     "/*"
+PATTERN_MIXES = {
+    "exact": {"exact": 1.0},
+    "mixed": {"exact": 0.6, "prefix": 0.3, "all": 0.1},
+    "all": {"all": 1.0},
+}
+
+# (publishers, subscribers, total messages/s, pattern mix)
+BENCH_CONFIGS = [
+    (1, 1, 500, "exact"),
+    (1, 10, 500, "mixed"),
+    (4, 50, 1000, "mixed"),
+    (10, 100, 1000, "mixed"),
+    (1, 100, 500, "all"),
+]
+
+SEED = 42  # same subscriber patterns on every run
+
+# =========================================================
+# Simulated clients
+# =========================================================
+#
+# Probes are the ones osc_tester sends: (counter, seq, send_ts, payload),
+# with send_ts on the monotonic clock, which all processes on the host
+# share.
+
+def subscribe_message(client_id, topics):
+    return json.dumps({
+        "type": "subscribe",
+        "client_id": client_id,
+        "topics": topics,
+        "formats": [FORMAT_BINARY],
+    })
+
+
+async def discard(ws):
+    # publishers still get state updates; keep them from piling up
+    async for _ in ws:
+        pass
+
+
+async def publisher(url, dataset, rate, count, start_at, sent):
+    client_id = str(uuid.uuid4())
+    origin = uuid.UUID(client_id).bytes
+    probes = [
+        (*encode_probe(seq, topic, payload), topic)
+        for seq, topic, payload in dataset
+    ]
+
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.send(subscribe_message(client_id, []))
+        drain = asyncio.create_task(discard(ws))
+
+        interval = 1.0 / rate
+        for i in range(count):
+            delay = start_at + i * interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            packet, args_offset, topic = probes[i % len(probes)]
+            struct.pack_into(">i", packet, args_offset, i)
+            struct.pack_into(">d", packet, args_offset + 8, time.monotonic())
+            await ws.send(pack_frame(origin, packet))
+            sent[topic] += 1
+
+        drain.cancel()
+
+
+async def receive(ws, result):
+    async for message in ws:
+        if isinstance(message, str):
+            continue
+
+        now = time.monotonic()
+        for start, end in frame_ranges(message):
+            send_ts = read_probe(message[start:end])[3]
+            result["latency"].record(now - send_ts)
+            result["received"] += 1
+
+
+async def subscriber(url, pattern, stop_at, result):
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.send(subscribe_message(str(uuid.uuid4()), [pattern]))
+        try:
+            await asyncio.wait_for(
+                receive(ws, result), stop_at - time.monotonic()
+            )
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_clients(url, dataset, publishers, patterns, start_at, stop_at):
+    sent = defaultdict(int)
+    result = {"latency": LatencyHistogram(), "received": 0, "errors": 0}
+
+    tasks = [
+        subscriber(url, pattern, stop_at, result) for pattern in patterns
+    ]
+    tasks += [
+        publisher(url, dataset, rate, count, start_at, sent)
+        for rate, count in publishers
+    ]
+    for outcome in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(outcome, Exception):
+            result["errors"] += 1
+
+    result["sent"] = dict(sent)
+    return result
+
+
+def client_process(*args):
+    return asyncio.run(run_clients(*args))
+
+# =========================================================
+# Broker process
+# =========================================================
+
+def start_server():
+    server = subprocess.Popen(
+        [sys.executable, "netosc_server.py", "--host", SERVER_HOST,
+         "--port", str(SERVER_PORT), *SERVER_ARGS],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    return server
+
+
+async def wait_for_server(url, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with websockets.connect(url):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def process_usage(pid):
+    # (cpu seconds, rss bytes, peak rss bytes) of a process and its
+    # children (workers) from /proc; None where /proc is not available
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+
+    cpu = rss = peak = 0
+    try:
+        for p in pids:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf(
+                "SC_CLK_TCK"
+            )
+
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+                    elif line.startswith("VmHWM:"):
+                        peak += int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+    return cpu, rss, peak
+
+# =========================================================
+# Benchmark
+# =========================================================
+
+def pick_patterns(count, mix, topics, rng):
+    kinds = list(PATTERN_MIXES[mix])
+    weights = [PATTERN_MIXES[mix][kind] for kind in kinds]
+
+    patterns = []
+    for kind in rng.choices(kinds, weights, k=count):
+        topic = rng.choice(topics)
+        if kind == "exact":
+            patterns.append(topic)
+        elif kind == "prefix":
+            patterns.append(topic[:3] + "*")
+        else:
+            patterns.append("/*")
+    return patterns
+
+
+def expected_deliveries(sent, patterns):
+    return sum(
+        count
+        for topic, count in sent.items()
+        for pattern in patterns
+        if pattern_matches(pattern, topic)
+    )
+
+
+async def run_config(dataset, publishers, subscribers, rate, mix, rng):
+    url = f"ws://{SERVER_HOST}:{SERVER_PORT}"
+    topics = sorted({topic for _, topic, _ in dataset})
+    patterns = pick_patterns(subscribers, mix, topics, rng)
+
+    # every publisher sends the same share of the total rate
+    count = int(rate * DURATION_SECONDS / publishers)
+    publisher_specs = [(rate / publishers, count)] * publishers
+
+    server = start_server()
+    try:
+        await wait_for_server(url)
+
+        loop = asyncio.get_running_loop()
+        start_at = time.monotonic() + STARTUP_SECONDS
+        stop_at = start_at + DURATION_SECONDS + DRAIN_SECONDS
+
+        with ProcessPoolExecutor(CLIENT_PROCESSES) as pool:
+            runs = [
+                loop.run_in_executor(
+                    pool, client_process, url, dataset,
+                    publisher_specs[i::CLIENT_PROCESSES],
+                    patterns[i::CLIENT_PROCESSES], start_at, stop_at
+                )
+                for i in range(CLIENT_PROCESSES)
+            ]
+
+            await asyncio.sleep(start_at - time.monotonic())
+            usage_start = process_usage(server.pid)
+            await asyncio.sleep(DURATION_SECONDS)
+            usage_end = process_usage(server.pid)
+
+            results = await asyncio.gather(*runs)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latency = LatencyHistogram()
+    sent = defaultdict(int)
+    received = errors = 0
+    for result in results:
+        latency.merge(result["latency"])
+        received += result["received"]
+        errors += result["errors"]
+        for topic, n in result["sent"].items():
+            sent[topic] += n
+
+    total_sent = sum(sent.values())
+    expected = expected_deliveries(sent, patterns)
+    summary = latency.summary()
+
+    row = {
+        "label": RUN_LABEL,
+        "commit": git_commit(),
+        "mix": mix,
+        "publishers": publishers,
+        "subscribers": subscribers,
+        "target_rate": rate,
+        "published_rate": round(total_sent / DURATION_SECONDS, 2),
+        "delivered_rate": round(received / DURATION_SECONDS, 2),
+        "sent": total_sent,
+        "delivered": received,
+        "expected": expected,
+        "delivery_ratio": round(received / expected, 4) if expected else 0,
+        "p50_ms": round(summary["p50"] * 1000, 3),
+        "p99_ms": round(summary["p99"] * 1000, 3),
+        "p999_ms": round(summary["p999"] * 1000, 3),
+        "max_ms": round(summary["max"] * 1000, 3),
+        "broker_cpu_percent": "",
+        "broker_rss_mb": "",
+        "broker_peak_rss_mb": "",
+        "client_errors": errors,
+    }
+
+    if usage_start is not None and usage_end is not None:
+        row["broker_cpu_percent"] = round(
+            (usage_end[0] - usage_start[0]) / DURATION_SECONDS * 100, 1
+        )
+        row["broker_rss_mb"] = round(usage_end[1] / 2**20, 1)
+        row["broker_peak_rss_mb"] = round(usage_end[2] / 2**20, 1)
+
+    return row
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def save_row(row):
+    new_file = not os.path.exists(RESULTS_FILE)
+    with open(RESULTS_FILE, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(row))
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def print_row(row):
+    print(
+        f"{row['publishers']:>4} pub {row['subscribers']:>5} sub "
+        f"{row['mix']:<6} {row['target_rate']:>6} msg/s | "
+        f"delivered {row['delivered_rate']:>9.1f} msg/s "
+        f"({row['delivery_ratio']:.1%}) | "
+        f"p50 {row['p50_ms']:7.2f} ms  p99 {row['p99_ms']:7.2f} ms  "
+        f"max {row['max_ms']:7.2f} ms | "
+        f"cpu {row['broker_cpu_percent']}%  "
+        f"rss {row['broker_rss_mb']} MB"
+    )
+
+# =========================================================
+# Main
+# =========================================================
+
+async def main():
+    dataset = load_dataset(DATASET_FILE)
+    rng = random.Random(SEED)
+
+    print(
+        f"Benchmarking {len(BENCH_CONFIGS)} configurations, "
+        f"{DURATION_SECONDS} s each, {CLIENT_PROCESSES} client processes"
+    )
+    for publishers, subscribers, rate, mix in BENCH_CONFIGS:
+        row = await run_config(
+            dataset, publishers, subscribers, rate, mix, rng
+        )
+        print_row(row)
+        save_row(row)
+
+    print(f"Results appended to {RESULTS_FILE}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+import asyncio
+from collections import deque
+
+# =========================================================
+# OSC ingress
+# =========================================================
+#
+# A lean UDP endpoint that hands over raw OSC datagrams without decoding
+# them and without creating a task per packet. Packets are either passed
+# synchronously to on_packet from datagram_received, or appended to a
+# bounded queue that one long-lived consumer drains in arrival order via
+# packets(). When the queue is full the oldest packet is dropped.
+
+INGRESS_QUEUE_SIZE = 4096
+
+
+class OSCIngress(asyncio.DatagramProtocol):
+    def __init__(self, on_packet=None, queue_size=INGRESS_QUEUE_SIZE):
+        self.on_packet = on_packet
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.ready = asyncio.Event()
+        self.received = 0
+        self.dropped = 0
+
+    def datagram_received(self, data, addr):
+        self.received += 1
+
+        if self.on_packet is not None:
+            self.on_packet(data)
+            return
+
+        if len(self.queue) >= self.queue_size:
+            self.queue.popleft()
+            self.dropped += 1
+
+        self.queue.append(data)
+        self.ready.set()
+
+    async def packets(self):
+        while True:
+            await self.ready.wait()
+            while self.queue:
+                yield self.queue.popleft()
+            self.ready.clear()
+
+
+async def open_ingress(ip, port, on_packet=None,
+                       queue_size=INGRESS_QUEUE_SIZE):
+    loop = asyncio.get_running_loop()
+    transport, ingress = await loop.create_datagram_endpoint(
+        lambda: OSCIngress(on_packet, queue_size),
+        local_addr=(ip, port)
+    )
+    return transport, ingress
@@ -0,0 +1,241 @@
+import csv
+import math
+import struct
+from collections import defaultdict, deque
+
+# =========================================================
+# Latency histogram
+# =========================================================
+#
+# HDR-style histogram: every power of two is split into SUB_BUCKETS
+# equally wide buckets, so any recorded value is known to within about
+# 1 / SUB_BUCKETS of itself, from microseconds to minutes, in a few
+# hundred counters. Memory does not depend on the number of samples.
+
+SUB_BUCKETS = 64
+MIN_VALUE = 1e-9  # values are clamped to this before bucketing
+
+
+class LatencyHistogram:
+    def __init__(self, sub_buckets=SUB_BUCKETS):
+        self.sub_buckets = sub_buckets
+        self.counts = defaultdict(int)  # bucket -> samples
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        mantissa, exponent = math.frexp(max(value, MIN_VALUE))
+        sub_bucket = int((mantissa - 0.5) * 2 * self.sub_buckets)
+        self.counts[exponent * self.sub_buckets + sub_bucket] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        # adds the samples of another histogram with the same sub_buckets
+        for bucket, count in other.counts.items():
+            self.counts[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def bucket_value(self, bucket):
+        # midpoint of the bucket
+        exponent, sub_bucket = divmod(bucket, self.sub_buckets)
+        mantissa = 0.5 + (sub_bucket + 0.5) / (2 * self.sub_buckets)
+        return math.ldexp(mantissa, exponent)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.bucket_value(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "max": self.max,
+        }
+
+
+def size_class(size):
+    # payload size bucket: the next power of two, at least 64 bytes
+    return max(64, 1 << (size - 1).bit_length())
+
+# =========================================================
+# Loss tracking
+# =========================================================
+#
+# Every test message carries a global send counter. The tracker keeps one
+# byte per counter in a sliding window of LOSS_WINDOW counters behind the
+# highest one received. A counter still missing when it falls out of the
+# window is lost; lost counters in a row form a burst. Bursts show where
+# loss happens: UDP drops tend to be single messages, an overflowing send
+# queue drops long runs. Counters seen twice are duplicates. Counters
+# arriving below the highest one are reordered, by that many positions.
+
+LOSS_WINDOW = 4096
+GAP_LOG_MIN = 10  # bursts at least this long are logged individually
+GAP_LOG_SIZE = 100
+
+
+class LossTracker:
+    def __init__(self, window=LOSS_WINDOW):
+        self.window = window
+        self.seen = bytearray(window)
+        self.base = 0  # counters below base are settled
+        self.highest = -1
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.max_reorder_depth = 0
+        self.late = 0  # arrived after leaving the window, counted as lost
+        self.bursts = defaultdict(int)  # burst length -> count
+        self.gaps = deque(maxlen=GAP_LOG_SIZE)  # (first counter, length)
+        self.burst_start = None
+
+    def record(self, counter):
+        if counter < self.base:
+            self.late += 1
+            return
+
+        if counter >= self.base + self.window:
+            self.settle(counter - self.window + 1)
+
+        slot = counter % self.window
+        if self.seen[slot]:
+            self.duplicates += 1
+            return
+
+        self.seen[slot] = 1
+        self.received += 1
+
+        if counter < self.highest:
+            self.reordered += 1
+            self.max_reorder_depth = max(
+                self.max_reorder_depth, self.highest - counter
+            )
+        else:
+            self.highest = counter
+
+    def settle(self, end):
+        # counters below end can no longer arrive in time
+        seen = self.seen
+        for counter in range(self.base, end):
+            slot = counter % self.window
+            if seen[slot]:
+                seen[slot] = 0
+                if self.burst_start is not None:
+                    self.end_burst(counter)
+            else:
+                self.lost += 1
+                if self.burst_start is None:
+                    self.burst_start = counter
+        self.base = end
+
+    def end_burst(self, end):
+        length = end - self.burst_start
+        self.bursts[length] += 1
+        if length >= GAP_LOG_MIN:
+            self.gaps.append((self.burst_start, length))
+        self.burst_start = None
+
+    def finish(self, sent):
+        # settles everything; counters up to sent that never arrived are lost
+        self.settle(max(sent, self.highest + 1))
+        if self.burst_start is not None:
+            self.end_burst(self.base)
+
+    def burst_summary(self):
+        classes = {"1": 0, "2-9": 0, "10-99": 0, "100+": 0}
+        for length, count in self.bursts.items():
+            if length == 1:
+                classes["1"] += count
+            elif length < 10:
+                classes["2-9"] += count
+            elif length < 100:
+                classes["10-99"] += count
+            else:
+                classes["100+"] += count
+        return classes
+
+# =========================================================
+# Result files
+# =========================================================
+#
+# Raw samples are streamed to disk in batches instead of being kept in
+# memory. "csv" writes seq_id,topic,rtt_seconds,counter rows, the file
+# test-results/plots.py reads; "binary" writes compact records:
+#
+#   seq (int32) | counter (int32) | rtt seconds (float64) |
+#   topic length (uint16) | topic
+
+BINARY_RECORD = struct.Struct("<iidH")
+
+
+class ResultWriter:
+    def __init__(self, path, fmt="csv", batch_size=1000):
+        self.format = fmt
+        self.batch_size = batch_size
+        self.rows = []
+        self.written = 0
+
+        if fmt == "binary":
+            self.file = open(path, "wb")
+        else:
+            self.file = open(path, "w", newline="")
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(
+                ["seq_id", "topic", "rtt_seconds", "counter"]
+            )
+
+    def write(self, seq, topic, rtt, counter):
+        self.rows.append((seq, topic, rtt, counter))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.format == "binary":
+            parts = []
+            for seq, topic, rtt, counter in self.rows:
+                topic = topic.encode()
+                parts.append(
+                    BINARY_RECORD.pack(seq, counter, rtt, len(topic))
+                )
+                parts.append(topic)
+            self.file.write(b"".join(parts))
+        else:
+            self.writer.writerows(self.rows)
+
+        self.written += len(self.rows)
+        self.rows.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def read_binary_results(path):
+    # yields (seq_id, topic, rtt_seconds, counter) from a "binary" file
+    with open(path, "rb") as f:
+        data = f.read()
+
+    index = 0
+    while index < len(data):
+        seq, counter, rtt, topic_size = BINARY_RECORD.unpack_from(data, index)
+        index += BINARY_RECORD.size
+        yield seq, data[index:index + topic_size].decode(), rtt, counter
+        index += topic_size
@@ -1,7 +1,7 @@
 import asyncio
-from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import AsyncIOOSCUDPServer
-from pythonosc.udp_client import SimpleUDPClient
+import socket
+
+from osc_ingress import open_ingress
 
 LISTEN_IP = "127.0.0.1"
 LISTEN_PORT = 8000      # mirror listens here
@@ -9,30 +9,18 @@ LISTEN_PORT = 8000      # mirror listens here
 TARGET_IP = "127.0.0.1"
 TARGET_PORT = 9000     # send back to tester via netOSC client
 
-osc_out = SimpleUDPClient(TARGET_IP, TARGET_PORT)
-
-
-async def osc_handler(address, *args):
-    osc_out.send_message(address, args)
+osc_out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
 
-def osc_handler_sync(address, *args):
-    asyncio.get_running_loop().create_task(
-        osc_handler(address, *args)
-    )
+def osc_handler(packet):
+    # echo the datagram unchanged, straight from the receive callback
+    osc_out.sendto(packet, (TARGET_IP, TARGET_PORT))
 
 
 async def main():
-    dispatcher = Dispatcher()
-    dispatcher.set_default_handler(osc_handler_sync)
-
-    server = AsyncIOOSCUDPServer(
-        (LISTEN_IP, LISTEN_PORT),
-        dispatcher,
-        asyncio.get_running_loop()
+    transport, _ = await open_ingress(
+        LISTEN_IP, LISTEN_PORT, on_packet=osc_handler
     )
-
-    transport, _ = await server.create_serve_endpoint()
     print(f"OSC mirror listening on {LISTEN_IP}:{LISTEN_PORT}")
 
     await asyncio.Future()  # run forever
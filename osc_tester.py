@@ -1,30 +1,84 @@
 import asyncio
 import csv
 import json
+import os
+import random
+import socket
+import struct
 import time
 import base64
-
-from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import AsyncIOOSCUDPServer
-from pythonosc.udp_client import SimpleUDPClient
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from pythonosc.osc_message import OscMessage
+from pythonosc.osc_message_builder import OscMessageBuilder
+
+from netosc_wire import TRACE_HOPS, iter_messages, trace_id
+from osc_ingress import open_ingress
+from osc_latency import (
+    LatencyHistogram,
+    GAP_LOG_MIN,
+    LossTracker,
+    ResultWriter,
+    size_class,
+)
 
 # =========================================================
 # Configuration
 # =========================================================
-MESSAGES_PER_SECOND = 500
+MESSAGES_PER_SECOND = 500  # target rate, summed over all senders
 DURATION_SECONDS = 30
 
+# Arrival profile of the send schedule:
+#   "constant"  evenly spaced messages
+#   "poisson"   exponentially distributed gaps (random arrivals)
+#   "burst"     BURST_SIZE messages back to back, bursts evenly spaced
+SEND_PROFILE = "constant"
+BURST_SIZE = 10
+
+# Each sender is a separate process with its own socket, simulating one
+# publisher. Sender i sends to SEND_PORTS[i % len(SEND_PORTS)], so several
+# netOSC clients can be loaded at once.
+SENDER_PROCESSES = 1
+
+# Senders sleep until shortly before each deadline and busy-wait the rest
+SPIN_SECONDS = 0.0005
+
+RATE_LOG_FILE = "load_runs.csv"  # target vs. achieved rate of every run
+
 DATASET_FILE = "netosc_test_dataset.jsonl"
-OUTPUT_FILE = f"netOSC{MESSAGES_PER_SECOND}.csv"
+
+# prefix of the output file; use e.g. "netOSC-batch" for runs where the
+# netOSC client batches outgoing messages (-b), so both modes can be plotted
+RUN_LABEL = "netOSC"
+OUTPUT_FILE = f"{RUN_LABEL}{MESSAGES_PER_SECOND}.csv"
+
+# Raw RTT samples are streamed to OUTPUT_FILE in batches of WRITE_BATCH:
+# "csv" (read by test-results/plots.py), "binary" (see osc_latency.py) or
+# None to keep only the histograms, e.g. for long soak runs
+RESULTS_FORMAT = "csv"
+WRITE_BATCH = 1000
+
+REPORT_INTERVAL = 1.0  # seconds between live snapshots, 0 = off
 
 # netOSC client A
 SEND_IP = "127.0.0.1"
 SEND_PORT = 9000      # netOSC client A listens here
+SEND_PORTS = [SEND_PORT]
 
 # tester receives replies here
 RECV_IP = "0.0.0.0"
 RECV_PORT = 8000      # must match client A target port
 
+# Per-hop breakdown of traced messages: the netOSC clients report their
+# traces to this port (their TRACE_COLLECTOR), None = off. TRACE_SAMPLE
+# must match the clients' setting. One round trip passes TRACE_LEGS
+# client-to-client legs, two when echoed by osc_mirror.
+TRACE_IP = "0.0.0.0"
+TRACE_PORT = None
+TRACE_SAMPLE = 100
+TRACE_LEGS = 2
+
 # =========================================================
 # Load dataset (NO timestamps inside)
 # =========================================================
@@ -54,89 +108,454 @@ def load_dataset(path):
 
 START_TIME = time.monotonic()
 
-results = []
+latency = LatencyHistogram()
+interval_latency = LatencyHistogram()
+topic_latency = defaultdict(LatencyHistogram)
+size_latency = defaultdict(LatencyHistogram)  # size class -> histogram
+loss = LossTracker()
+result_writer = None
+
+# the traces use wall-clock time, RTTs the monotonic clock
+WALL_OFFSET = time.time() - time.monotonic()
+
+def osc_string_end(packet, start):
+    # index after the null-padded OSC string starting at start
+    return (packet.index(b"\0", start) // 4 + 1) * 4
+
+
+def read_probe(packet):
+    # Returns (address, counter, seq, send_ts) of a test message. Only the
+    # address, type tags and the first three arguments are read; the
+    # payload is not decoded. The timestamp is a double, or a float after a
+    # trip through netOSC's JSON format.
+    tags_start = osc_string_end(packet, 0)
+    args_start = osc_string_end(packet, tags_start)
+    address = packet[:packet.index(b"\0")].decode()
+
+    tags = packet[tags_start + 1:tags_start + 4]
+    if tags == b"iid":
+        counter, seq, send_ts = struct.unpack_from(">iid", packet, args_start)
+    elif tags == b"iif":
+        counter, seq, send_ts = struct.unpack_from(">iif", packet, args_start)
+    else:
+        counter, seq, send_ts = OscMessage(packet).params[:3]
+
+    return address, counter, seq, send_ts
 
-async def recv_handler(address, seq_id, send_ts, payload):
+
+def recv_handler(packet):
+    # runs synchronously in the receive callback, no task per packet
     recv_ts = time.monotonic() - START_TIME
-    rtt = recv_ts - send_ts
-    results.append((seq_id, address, rtt))
 
+    for message in iter_messages(packet):
+        address, counter, seq_id, send_ts = read_probe(message)
+        rtt = recv_ts - send_ts
 
-def recv_handler_sync(address, *args):
-    asyncio.get_running_loop().create_task(
-        recv_handler(address, *args)
-    )
+        latency.record(rtt)
+        interval_latency.record(rtt)
+        topic_latency[address].record(rtt)
+        size_latency[size_class(len(message))].record(rtt)
+        loss.record(counter)
 
+        if result_writer is not None:
+            result_writer.write(seq_id, address, rtt, counter)
 
-async def start_receiver():
-    dispatcher = Dispatcher()
-    dispatcher.set_default_handler(recv_handler_sync)
+        if TRACE_PORT is not None:
+            note_traced(message, send_ts, recv_ts)
 
-    server = AsyncIOOSCUDPServer(
-        (RECV_IP, RECV_PORT),
-        dispatcher,
-        asyncio.get_running_loop()
-    )
 
-    transport, _ = await server.create_serve_endpoint()
+async def start_receiver():
+    transport, _ = await open_ingress(
+        RECV_IP, RECV_PORT, on_packet=recv_handler
+    )
     print(f"Tester listening on {RECV_IP}:{RECV_PORT}")
     return transport
 
 # =========================================================
-# Sender (cyclic replay, timestamp injected here)
+# Trace collection
 # =========================================================
+#
+# Traces are joined by their id, the checksum of the OSC packet, which is
+# the same on every leg as long as the packet bytes stay the same; with
+# the JSON wire format the echoed packet is re-encoded and does not match.
+# Once all legs of a message have been reported, its RTT is split into
+# segments between consecutive stamps, from the tester's send over every
+# hop of every leg back to the tester. Stamps from different hosts differ
+# by their clock offset.
+
+TRACE_PENDING = 10000  # incomplete traces kept before the oldest are dropped
+
+trace_times = {}  # id -> (send, receive) wall-clock time
+trace_reports = defaultdict(list)  # id -> stamps of the legs reported
+segment_latency = {}  # "from→to" -> LatencyHistogram
+traces_joined = 0
+
+
+def note_traced(message, send_ts, recv_ts):
+    packet_id = trace_id(message)
+    if packet_id % TRACE_SAMPLE:
+        return
+
+    offset = START_TIME + WALL_OFFSET
+    trace_times[packet_id] = (send_ts + offset, recv_ts + offset)
+    join_trace(packet_id)
+
+
+def trace_handler(packet):
+    try:
+        report = json.loads(packet)
+    except ValueError:
+        return
+    if report.get("type") != "trace":
+        return
+
+    trace_reports[report["id"]].append(report["stamps"])
+    join_trace(report["id"])
+
+
+def join_trace(packet_id):
+    global traces_joined
+
+    legs = trace_reports.get(packet_id)
+    if (packet_id not in trace_times or legs is None
+            or len(legs) < TRACE_LEGS):
+        for pending in (trace_times, trace_reports):
+            while len(pending) > TRACE_PENDING:
+                del pending[next(iter(pending))]
+        return
+
+    send, receive = trace_times.pop(packet_id)
+    del trace_reports[packet_id]
+    traces_joined += 1
+
+    # legs in the order they were travelled
+    legs.sort(key=lambda stamps: stamps[0][1])
+    points = [("tester_send", send)]
+    for leg, stamps in enumerate(legs, 1):
+        points.extend((f"L{leg} {TRACE_HOPS[hop]}", t) for hop, t in stamps)
+    points.append(("tester_recv", receive))
+
+    for (start, t_start), (end, t_end) in zip(points, points[1:]):
+        name = f"{start}→{end}"
+        histogram = segment_latency.get(name)
+        if histogram is None:
+            histogram = segment_latency[name] = LatencyHistogram()
+        histogram.record(t_end - t_start)
+
+
+async def start_trace_collector():
+    transport, _ = await open_ingress(
+        TRACE_IP, TRACE_PORT, on_packet=trace_handler
+    )
+    print(f"Collecting traces on {TRACE_IP}:{TRACE_PORT}")
+    return transport
+
+# =========================================================
+# Reporting
+# =========================================================
+
+def format_latency(summary):
+    return (
+        f"p50 {summary['p50'] * 1000:7.2f} ms  "
+        f"p99 {summary['p99'] * 1000:7.2f} ms  "
+        f"p99.9 {summary['p999'] * 1000:7.2f} ms  "
+        f"max {summary['max'] * 1000:7.2f} ms"
+    )
+
+
+async def report_intervals():
+    # prints one line per REPORT_INTERVAL for the messages received in it
+    global interval_latency
 
-async def sender(dataset, messages_per_second, duration_seconds):
-    osc_out = SimpleUDPClient(SEND_IP, SEND_PORT)
+    # loss is only known once counters leave the tracker's window, so
+    # that column lags by LOSS_WINDOW messages
+    last_time = time.monotonic()
+    last = (0, 0, 0, 0)
 
-    interval = 1.0 / messages_per_second
-    max_messages = int(messages_per_second * duration_seconds)
-    dataset_len = len(dataset)
+    while True:
+        await asyncio.sleep(REPORT_INTERVAL)
 
-    print(f"Sending {max_messages} messages at {messages_per_second} msg/s")
+        now = time.monotonic()
+        snapshot = interval_latency
+        interval_latency = LatencyHistogram()
 
-    for i in range(max_messages):
-        seq, topic, payload = dataset[i % dataset_len]
+        current = (loss.received, loss.lost, loss.duplicates, loss.reordered)
+        received, lost, duplicates, reordered = (
+            c - l for c, l in zip(current, last)
+        )
+        settled = received + lost
 
-        send_ts = time.monotonic() - START_TIME
-        osc_out.send_message(topic, (seq, send_ts, payload))
+        print(
+            f"[{now - START_TIME:7.1f}s] "
+            f"{snapshot.count / (now - last_time):8.1f} msg/s  "
+            f"{format_latency(snapshot.summary())}  "
+            f"lost {lost} ({lost / settled if settled > 0 else 0:.2%})  "
+            f"dup {duplicates}  reordered {reordered}"
+        )
 
-        await asyncio.sleep(interval)
+        last_time = now
+        last = current
+
+
+def print_loss(sent):
+    print(
+        f"Lost: {loss.lost}, duplicates: {loss.duplicates}, "
+        f"reordered: {loss.reordered} "
+        f"(max depth {loss.max_reorder_depth}), late: {loss.late}"
+    )
+
+    bursts = ", ".join(
+        f"{length}: {count}" for length, count in loss.burst_summary().items()
+    )
+    print(f"Loss bursts by length: {bursts}")
+
+    if loss.gaps:
+        print(f"Gaps of {GAP_LOG_MIN}+ messages (at ~ s into the run):")
+        for first, length in loss.gaps:
+            print(
+                f"  {first / MESSAGES_PER_SECOND:8.2f}s  "
+                f"counter {first}  {length} messages"
+            )
+
+
+def print_breakdown(title, histograms, width=16):
+    print(title)
+    for key, histogram in histograms:
+        print(
+            f"  {key:<{width}} n={histogram.count:<8} "
+            f"{format_latency(histogram.summary())}"
+        )
+
+# =========================================================
+# Senders (cyclic replay, timestamp injected here)
+# =========================================================
+#
+# Every message has an absolute deadline computed from the start of the
+# run. A sender that falls behind sends the overdue messages right away
+# instead of shifting the rest of the schedule, so the achieved rate does
+# not drift below the target. Messages are encoded once up front; only the
+# send counter and timestamp are patched in before each send.
+#
+# Test messages carry (counter, seq, send_ts, payload). The counter is the
+# global message index, unique across senders and dataset cycles; seq is
+# the dataset entry.
+
+def encode_probe(seq, topic, payload):
+    # returns the message and the offset of its counter
+    builder = OscMessageBuilder(topic)
+    builder.add_arg(0, OscMessageBuilder.ARG_TYPE_INT)
+    builder.add_arg(seq, OscMessageBuilder.ARG_TYPE_INT)
+    builder.add_arg(0.0, OscMessageBuilder.ARG_TYPE_DOUBLE)
+    builder.add_arg(payload)
+    packet = bytearray(builder.build().dgram)
+
+    tags_start = osc_string_end(packet, 0)
+    return packet, osc_string_end(packet, tags_start)
+
+
+def schedule(sender_rate, count, profile):
+    # yields the deadlines of one sender, in seconds from the start
+    if profile == "poisson":
+        deadline = 0.0
+        for _ in range(count):
+            yield deadline
+            deadline += random.expovariate(sender_rate)
+
+    elif profile == "burst":
+        burst_interval = BURST_SIZE / sender_rate
+        for i in range(count):
+            yield (i // BURST_SIZE) * burst_interval
+
+    else:
+        interval = 1.0 / sender_rate
+        for i in range(count):
+            yield i * interval
+
+
+def wait_until(deadline):
+    remaining = deadline - time.monotonic()
+    if remaining > SPIN_SECONDS:
+        time.sleep(remaining - SPIN_SECONDS)
+    while time.monotonic() < deadline:
+        pass
+
+
+def sender(index, dataset, start_time, run_start):
+    # one sender process; sends every SENDER_PROCESSES-th message
+    port = SEND_PORTS[index % len(SEND_PORTS)]
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    max_messages = int(MESSAGES_PER_SECOND * DURATION_SECONDS)
+    indices = range(index, max_messages, SENDER_PROCESSES)
+    sender_rate = MESSAGES_PER_SECOND / SENDER_PROCESSES
+
+    probes = [encode_probe(*entry) for entry in dataset]
+    dataset_len = len(probes)
+
+    late = 0
+    max_lateness = 0.0
+    first_send = last_send = None
+
+    for i, deadline in zip(
+        indices, schedule(sender_rate, len(indices), SEND_PROFILE)
+    ):
+        deadline += run_start
+        wait_until(deadline)
+
+        packet, args_offset = probes[i % dataset_len]
+        now = time.monotonic()
+        struct.pack_into(">i", packet, args_offset, i)
+        struct.pack_into(">d", packet, args_offset + 8, now - start_time)
+        sock.sendto(packet, (SEND_IP, port))
+
+        lateness = now - deadline
+        if lateness > 0.001:
+            late += 1
+        max_lateness = max(max_lateness, lateness)
+        if first_send is None:
+            first_send = now
+        last_send = now
+
+    return {
+        "sender": index,
+        "port": port,
+        "sent": len(indices),
+        "first_send": first_send,
+        "last_send": last_send,
+        "late": late,
+        "max_lateness": max_lateness,
+    }
+
+
+async def run_senders(dataset):
+    loop = asyncio.get_running_loop()
+
+    print(
+        f"Sending {int(MESSAGES_PER_SECOND * DURATION_SECONDS)} messages at "
+        f"{MESSAGES_PER_SECOND} msg/s ({SEND_PROFILE}) from "
+        f"{SENDER_PROCESSES} sender(s) to ports {SEND_PORTS}"
+    )
+
+    # give the sender processes time to start and encode before the first
+    # deadline
+    run_start = time.monotonic() + 1.0
+
+    with ProcessPoolExecutor(SENDER_PROCESSES) as pool:
+        return await asyncio.gather(*(
+            loop.run_in_executor(
+                pool, sender, index, dataset, START_TIME, run_start
+            )
+            for index in range(SENDER_PROCESSES)
+        ))
+
+
+def achieved_rate(reports):
+    sent = sum(r["sent"] for r in reports)
+    started = [r for r in reports if r["first_send"] is not None]
+    if sent < 2 or not started:
+        return 0.0
+
+    duration = (
+        max(r["last_send"] for r in started)
+        - min(r["first_send"] for r in started)
+    )
+    # n messages span n - 1 gaps at the target rate
+    return (sent - 1) / duration if duration > 0 else 0.0
+
+
+def log_run(reports, received):
+    sent = sum(r["sent"] for r in reports)
+    row = {
+        "label": RUN_LABEL,
+        "profile": SEND_PROFILE,
+        "senders": SENDER_PROCESSES,
+        "target_rate": MESSAGES_PER_SECOND,
+        "achieved_rate": round(achieved_rate(reports), 2),
+        "sent": sent,
+        "received": received,
+        "late": sum(r["late"] for r in reports),
+        "max_lateness_ms": round(
+            max(r["max_lateness"] for r in reports) * 1000, 3
+        ),
+    }
+
+    new_file = not os.path.exists(RATE_LOG_FILE)
+    with open(RATE_LOG_FILE, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(row))
+        if new_file:
+            writer.writeheader()
+        writer.writerow(row)
+
+    return row
 
 # =========================================================
 # Main
 # =========================================================
 
 async def main():
+    global result_writer
+
     dataset = load_dataset(DATASET_FILE)
     print(f"Loaded dataset with {len(dataset)} messages")
 
+    if RESULTS_FORMAT is not None:
+        result_writer = ResultWriter(OUTPUT_FILE, RESULTS_FORMAT, WRITE_BATCH)
+
     recv_transport = await start_receiver()
 
-    await sender(
-        dataset,
-        MESSAGES_PER_SECOND,
-        DURATION_SECONDS
-    )
+    trace_transport = None
+    if TRACE_PORT is not None:
+        trace_transport = await start_trace_collector()
+
+    reporter = None
+    if REPORT_INTERVAL > 0:
+        reporter = asyncio.create_task(report_intervals())
+
+    reports = await run_senders(dataset)
 
     # allow late packets to arrive
     await asyncio.sleep(3)
 
     recv_transport.close()
-
-    with open(OUTPUT_FILE, "w", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow(["seq_id", "topic", "rtt_seconds"])
-        writer.writerows(results)
-
-    sent = int(MESSAGES_PER_SECOND * DURATION_SECONDS)
-    received = len(results)
-
+    if trace_transport is not None:
+        trace_transport.close()
+    if reporter is not None:
+        reporter.cancel()
+
+    sent = sum(r["sent"] for r in reports)
+    loss.finish(sent)
+    received = loss.received
+    run = log_run(reports, received)
+
+    print(f"Run: {RUN_LABEL}")
+    print(
+        f"Rate: target {MESSAGES_PER_SECOND} msg/s, "
+        f"achieved {run['achieved_rate']:.1f} msg/s "
+        f"({run['late']} late > 1 ms, max {run['max_lateness_ms']} ms)"
+    )
     print(f"Sent: {sent}, Received: {received}")
     if sent > 0:
         print(f"Loss rate: {(sent - received) / sent:.2%}")
+    print_loss(sent)
+
+    print_breakdown("RTT:", [("all", latency)])
+    print_breakdown("RTT by topic:", sorted(topic_latency.items()))
+    print_breakdown(
+        "RTT by packet size:",
+        [(f"<= {size} B", h) for size, h in sorted(size_latency.items())]
+    )
 
-    print(f"Wrote {received} RTT samples to {OUTPUT_FILE}")
+    if TRACE_PORT is not None:
+        print_breakdown(
+            f"Per-hop latency ({traces_joined} traced round trips, "
+            f"{len(trace_times)} incomplete):",
+            segment_latency.items(),
+            width=40
+        )
+
+    if result_writer is not None:
+        result_writer.close()
+        print(f"Wrote {result_writer.written} RTT samples to {OUTPUT_FILE}")
 
 
 if __name__ == "__main__":
@@ -129,4 +129,44 @@ ax2.legend(frameon=False, ncol=2)
 fig2.tight_layout()
 fig2.savefig("rtt_percentiles.svg")
 
+# ============================================================
+# FIGURE 3 — BROKER BENCHMARK (osc_bench.py) PER COMMIT
+# ============================================================
+bench_file = Path("bench_results.csv")
+
+if bench_file.exists():
+    bench = pd.read_csv(bench_file, dtype={"commit": str})
+    bench["config"] = (
+        bench["publishers"].astype(str) + "p/"
+        + bench["subscribers"].astype(str) + "s "
+        + bench["mix"] + " @" + bench["target_rate"].astype(str)
+    )
+    configs = list(dict.fromkeys(bench["config"]))
+    commits = list(dict.fromkeys(bench["commit"].fillna("")))[-5:]
+
+    fig3, (ax3, ax4) = plt.subplots(1, 2, figsize=(20, 7))
+    x = np.arange(len(configs))
+
+    for commit in commits:
+        runs = bench[bench["commit"].fillna("") == commit]
+        runs = runs.groupby("config").last().reindex(configs)
+        ax3.plot(x, runs["p99_ms"], marker="^", linestyle=":",
+                 label=f"{commit} P99")
+        ax3.plot(x, runs["p50_ms"], marker="o", linestyle="-",
+                 label=f"{commit} P50")
+        ax4.plot(x, runs["delivered_rate"], marker="o", label=commit)
+
+    for ax in (ax3, ax4):
+        ax.set_xticks(x)
+        ax.set_xticklabels(configs, rotation=30, ha="right")
+        ax.grid(True, which="both", linestyle=":", linewidth=0.8)
+        ax.legend(frameon=False)
+
+    ax3.set_yscale("log")
+    ax3.set_ylabel("Latency [ms]")
+    ax4.set_ylabel("Delivered [msg/s]")
+
+    fig3.tight_layout()
+    fig3.savefig("bench_results.svg")
+
 plt.close("all")
@@ -0,0 +1,123 @@
+import argparse
+import asyncio
+import random
+
+# =========================================================
+# Configuration
+# =========================================================
+#
+# A UDP relay that sits between netOSC clients and the broker's UDP port
+# and makes the path worse on purpose: every datagram, in either
+# direction, is dropped with probability LOSS or held for DELAY plus up to
+# JITTER seconds, which also reorders them. Point a client at it with
+# UDP_ADDRESS = (LISTEN_IP, LISTEN_PORT) in netosc_client.py.
+#
+# Every client gets its own socket towards the broker, so the broker
+# still sees one address per client.
+
+LISTEN_IP = "127.0.0.1"
+LISTEN_PORT = 9900
+
+BROKER_IP = "127.0.0.1"
+BROKER_PORT = 8766  # the broker's UDP_PORT
+
+LOSS = 0.05
+DELAY = 0.02  # seconds
+JITTER = 0.01  # seconds, uniformly added to DELAY
+
+# =========================================================
+# Relay
+# =========================================================
+
+stats = {"forwarded": 0, "dropped": 0}
+
+
+def impair(transport, data, addr=None):
+    if random.random() < LOSS:
+        stats["dropped"] += 1
+        return
+
+    stats["forwarded"] += 1
+    args = (data,) if addr is None else (data, addr)
+    asyncio.get_running_loop().call_later(
+        DELAY + random.uniform(0, JITTER), transport.sendto, *args
+    )
+
+
+class BrokerSide(asyncio.DatagramProtocol):
+    # one per client: datagrams from the broker go back to that client
+    def __init__(self, listener, client):
+        self.listener = listener
+        self.client = client
+
+    def datagram_received(self, data, addr):
+        impair(self.listener.transport, data, self.client)
+
+
+class ClientSide(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.transport = None
+        self.upstream = {}  # client address -> transport towards the broker
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        upstream = self.upstream.get(addr)
+        if upstream is None:
+            self.upstream[addr] = asyncio.get_running_loop().create_task(
+                self.connect(addr, data)
+            )
+            return
+
+        if isinstance(upstream, asyncio.Task):
+            return  # still connecting; lost like any other datagram
+        impair(upstream, data)
+
+    async def connect(self, client, first):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: BrokerSide(self, client),
+            remote_addr=(BROKER_IP, BROKER_PORT)
+        )
+        self.upstream[client] = transport
+        print(f"New client {client[0]}:{client[1]}")
+        impair(transport, first)
+
+
+async def report():
+    while True:
+        await asyncio.sleep(5)
+        print(
+            f"forwarded {stats['forwarded']}, dropped {stats['dropped']}"
+        )
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    await loop.create_datagram_endpoint(
+        ClientSide, local_addr=(LISTEN_IP, LISTEN_PORT)
+    )
+    print(
+        f"UDP shim {LISTEN_IP}:{LISTEN_PORT} → {BROKER_IP}:{BROKER_PORT} "
+        f"(loss {LOSS:.0%}, delay {DELAY * 1000:g} ms "
+        f"+ up to {JITTER * 1000:g} ms)"
+    )
+    await report()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="UDP relay with loss and delay, for testing"
+    )
+    parser.add_argument("--listen-port", type=int, default=LISTEN_PORT)
+    parser.add_argument("--broker-port", type=int, default=BROKER_PORT)
+    parser.add_argument("--loss", type=float, default=LOSS)
+    parser.add_argument("--delay", type=float, default=DELAY)
+    parser.add_argument("--jitter", type=float, default=JITTER)
+    args = parser.parse_args()
+
+    LISTEN_PORT, BROKER_PORT = args.listen_port, args.broker_port
+    LOSS, DELAY, JITTER = args.loss, args.delay, args.jitter
+
+    asyncio.run(main())